@@ -6,7 +6,16 @@ if ($_SERVER["REQUEST_METHOD"] == "GET") {
     exit();
 }
 
-$data = json_decode(file_get_contents("php://input"), true);
+header("Accept-Encoding: gzip");
+$GZIP = str_contains($_SERVER["HTTP_ACCEPT_ENCODING"] ?? "", "gzip");
+$ENCODING = $_SERVER["HTTP_CONTENT_ENCODING"] ?? null;
+$RAW = ($_SERVER["CONTENT_TYPE"] ?? "") === "application/octet-stream";
+$BATCH = false;
+$CHANGED = false;
+
+if ($RAW) $data = array_merge($_GET, ["password" => $_SERVER["HTTP_X_MAM_PASSWORD"] ?? null]);
+else if ($ENCODING === "gzip") $data = json_decode(gzdecode(file_get_contents("php://input")), true);
+else $data = json_decode(file_get_contents("php://input"), true);
 
 function arg($name) {
     global $data;
@@ -15,7 +24,12 @@ function arg($name) {
     return $data[$name];
 }
 
+class ActionError extends Exception {}
+
 function error($msg) {
+    global $BATCH;
+
+    if ($BATCH) throw new ActionError($msg);
     header("Content-Type: application/json");
     print(json_encode(["good" => false, "error" => $msg]));
     file_put_contents("php://stderr", $msg . "\n");
@@ -23,19 +37,123 @@ function error($msg) {
 }
 
 function respond($data = null) {
-    $data = ["good" => true, "data" => $data];
+    global $GZIP;
 
+    $data = json_encode(["good" => true, "data" => $data]);
     header("Content-Type: application/json");
-    print(json_encode($data));
+
+    if ($GZIP && strlen($data) >= 1024) {
+        header("Content-Encoding: gzip");
+        $data = gzencode($data);
+    }
+
+    print($data);
     exit();
 }
 
+function compressible($fp) {
+    $sample = fread($fp, 65536);
+    rewind($fp);
+    return strlen(gzencode($sample, 1)) < strlen($sample) * 0.9;
+}
+
+function migrate($version, $migration) {
+    global $db;
+
+    if ($db->querySingle("PRAGMA user_version") >= $version) return;
+    $db->exec("BEGIN IMMEDIATE");
+    if ($db->querySingle("PRAGMA user_version") < $version) {
+        $migration();
+        $db->exec("PRAGMA user_version = $version");
+    }
+
+    $db->exec("COMMIT");
+}
+
+function blob_path($hash) {
+    if (!is_string($hash) || !preg_match("/^[0-9a-f]{64}$/", $hash)) error("Invalid hash");
+    return "/data/blobs/$hash";
+}
+
+function blob_put($content) {
+    $hash = hash("sha256", $content);
+    $path = blob_path($hash);
+
+    if (!file_exists($path)) {
+        file_put_contents("$path." . getmypid(), $content);
+        rename("$path." . getmypid(), $path);
+    }
+
+    return $hash;
+}
+
+function upload_path($session) {
+    blob_path($session);
+    return "/data/uploads/$session";
+}
+
+function upload_clear($dir) {
+    foreach (scandir($dir) as $name) if ($name !== "." && $name !== "..") @unlink("$dir/$name");
+    @rmdir($dir);
+}
+
+function blob_gc() {
+    global $db;
+
+    if (file_exists("/data/blobs/.gc") && filemtime("/data/blobs/.gc") > time() - 86400) return;
+    touch("/data/blobs/.gc");
+
+    $hashes = [];
+    $result = $db->query("SELECT `hash` FROM `files`");
+    while ($row = $result->fetchArray(SQLITE3_ASSOC)) $hashes[$row["hash"]] = true;
+
+    $result = $db->query("SELECT `content` FROM `directories`");
+    while ($row = $result->fetchArray(SQLITE3_ASSOC))
+        foreach (json_decode($row["content"], true)["files"] as $entry) $hashes[$entry["hash"]] = true;
+
+    $result = $db->query("SELECT `hash` FROM `builds`");
+    while ($row = $result->fetchArray(SQLITE3_ASSOC)) $hashes[$row["hash"]] = true;
+
+    foreach (scandir("/data/blobs") as $name) {
+        if (!preg_match("/^[0-9a-f]{64}$/", $name) || isset($hashes[$name])) continue;
+        if (filemtime("/data/blobs/$name") < time() - 3600) unlink("/data/blobs/$name");
+    }
+
+    foreach (scandir("/data/uploads") as $name) {
+        if (!preg_match("/^[0-9a-f]{64}$/", $name)) continue;
+        if (filemtime("/data/uploads/$name") < time() - 86400) upload_clear("/data/uploads/$name");
+    }
+}
+
+function changed($type) {
+    global $db, $BATCH, $CHANGED;
+
+    $stmt = $db->prepare("INSERT OR REPLACE INTO `changes` (`type`, `id`) VALUES (:type, :id)");
+    $stmt->bindValue(":type", $type);
+    $stmt->bindValue(":id", arg("id"));
+    $stmt->execute();
+
+    if ($BATCH) $CHANGED = true;
+    else touch("/data/changes");
+}
+
+function revision() {
+    global $db;
+
+    return $db->querySingle("SELECT COALESCE(MAX(`revision`), 0) FROM `changes`");
+}
+
 $PASSWORD = getenv("MAM_PASSWORD");
 if (!$PASSWORD) error("MAM_PASSWORD not set");
 if (is_null($data)) error("Invalid request");
 if (arg("password") !== $PASSWORD) error("Invalid password");
 
+if (!is_dir("/data/blobs")) mkdir("/data/blobs");
+if (!is_dir("/data/uploads")) mkdir("/data/uploads");
+if (!file_exists("/data/changes")) touch("/data/changes");
+
 $db = new SQLite3("/data/mam.db");
+$db->busyTimeout(10000);
 $db->exec("CREATE TABLE IF NOT EXISTS `files` (
     `id` TEXT PRIMARY KEY,
     `version` INTEGER DEFAULT 0,
@@ -73,267 +191,836 @@ $db->exec("CREATE TABLE IF NOT EXISTS `additionals` (
     `mode` INTEGER DEFAULT 0
 )");
 
-switch (arg("action")) {
-    case "check":
-        respond(true);
+migrate(1, function () {
+    global $db;
 
-    case "file-create":
-        $stmt = $db->prepare("INSERT INTO `files` (`id`) VALUES (:id)");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
+    $db->exec("ALTER TABLE `files` RENAME COLUMN `content` TO `hash`");
 
-    case "file-delete":
-        $stmt = $db->prepare("DELETE FROM `files` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
-
-    case "file-exists":
-        $stmt = $db->prepare("SELECT COUNT(*) FROM `files` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        respond($result->fetchArray()[0] > 0);
-
-    case "file-list":
-        $stmt = $db->prepare("SELECT `id`, `version` FROM `files`");
-        $result = $stmt->execute();
-        $files = [];
-        while ($row = $result->fetchArray(SQLITE3_ASSOC)) $files[$row["id"]] = $row["version"];
-        respond($files);
-
-    case "file-set-content":
-        $stmt = $db->prepare("UPDATE `files` SET `content` = :content, `version` = :version WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":content", arg("content"));
-        $stmt->bindValue(":version", arg("version"));
-        $stmt->execute();
-        respond();
-
-    case "file-set-meta":
-        $stmt = $db->prepare("UPDATE `files` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":owner", arg("owner"));
-        $stmt->bindValue(":group", arg("group"));
-        $stmt->bindValue(":mode", arg("mode"));
-        $stmt->execute();
-        respond();
-
-    case "file-get-content":
-        $stmt = $db->prepare("SELECT `content` FROM `files` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond($row["content"]);
-
-    case "file-get-meta":
-        $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `files` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond($row);
-
-    case "directory-create":
-        $stmt = $db->prepare("INSERT INTO `directories` (`id`) VALUES (:id)");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
+    $files = [];
+    $result = $db->query("SELECT `id`, `hash` FROM `files`");
+    while ($row = $result->fetchArray(SQLITE3_ASSOC)) $files[$row["id"]] = blob_put(base64_decode($row["hash"]));
 
-    case "directory-delete":
-        $stmt = $db->prepare("DELETE FROM `directories` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
-
-    case "directory-exists":
-        $stmt = $db->prepare("SELECT COUNT(*) FROM `directories` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        respond($result->fetchArray()[0] > 0);
-
-    case "directory-list":
-        $stmt = $db->prepare("SELECT `id`, `version` FROM `directories`");
-        $result = $stmt->execute();
-        $directories = [];
-        while ($row = $result->fetchArray(SQLITE3_ASSOC)) $directories[$row["id"]] = $row["version"];
-        respond($directories);
-
-    case "directory-set-content":
-        $stmt = $db->prepare("UPDATE `directories` SET `content` = :content, `version` = :version WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":content", json_encode(arg("content")));
-        $stmt->bindValue(":version", arg("version"));
-        $stmt->execute();
-        respond();
-
-    case "directory-set-meta":
-        $stmt = $db->prepare("UPDATE `directories` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":owner", arg("owner"));
-        $stmt->bindValue(":group", arg("group"));
-        $stmt->bindValue(":mode", arg("mode"));
+    foreach ($files as $id => $hash) {
+        $stmt = $db->prepare("UPDATE `files` SET `hash` = :hash WHERE `id` = :id");
+        $stmt->bindValue(":id", $id);
+        $stmt->bindValue(":hash", $hash);
         $stmt->execute();
-        respond();
-
-    case "directory-get-content":
-        $stmt = $db->prepare("SELECT `content` FROM `directories` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond(json_decode($row["content"], true));
-
-    case "directory-get-meta":
-        $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `directories` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond($row);
-
-    case "package-add":
-        $stmt = $db->prepare("INSERT INTO `packages` (`id`) VALUES (:id)");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
+    }
 
-    case "package-remove":
-        $stmt = $db->prepare("DELETE FROM `packages` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
-
-    case "package-exists":
-        $stmt = $db->prepare("SELECT COUNT(*) FROM `packages` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        respond($result->fetchArray()[0] > 0);
-
-    case "package-list":
-        $stmt = $db->prepare("SELECT `id` FROM `packages`");
-        $result = $stmt->execute();
-        $packages = [];
-        while ($row = $result->fetchArray(SQLITE3_ASSOC)) $packages[] = $row["id"];
-        respond($packages);
-
-    case "partial-create":
-        $stmt = $db->prepare("INSERT INTO `partials` (`id`) VALUES (:id)");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
+    $directories = [];
+    $result = $db->query("SELECT `id`, `content` FROM `directories`");
+    while ($row = $result->fetchArray(SQLITE3_ASSOC)) {
+        $content = json_decode($row["content"], true);
+        foreach ($content["files"] as $file => $entry) {
+            $content["files"][$file]["hash"] = blob_put(base64_decode($entry["content"]));
+            unset($content["files"][$file]["content"]);
+        }
 
-    case "partial-delete":
-        $stmt = $db->prepare("DELETE FROM `partials` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
-
-    case "partial-exists":
-        $stmt = $db->prepare("SELECT COUNT(*) FROM `partials` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        respond($result->fetchArray()[0] > 0);
-
-    case "partial-list":
-        $stmt = $db->prepare("SELECT `id`, `version` FROM `partials`");
-        $result = $stmt->execute();
-        $partials = [];
-        while ($row = $result->fetchArray(SQLITE3_ASSOC)) $partials[$row["id"]] = $row["version"];
-        respond($partials);
-
-    case "partial-set-content":
-        $stmt = $db->prepare("UPDATE `partials` SET `content` = :content, `version` = :version WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":content", json_encode(arg("content")));
-        $stmt->bindValue(":version", arg("version"));
-        $stmt->execute();
-        respond();
-
-    case "partial-set-meta":
-        $stmt = $db->prepare("UPDATE `partials` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":owner", arg("owner"));
-        $stmt->bindValue(":group", arg("group"));
-        $stmt->bindValue(":mode", arg("mode"));
-        $stmt->execute();
-        respond();
-
-    case "partial-get-content":
-        $stmt = $db->prepare("SELECT `content` FROM `partials` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond(json_decode($row["content"], true));
-
-    case "partial-get-meta":
-        $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `partials` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond($row);
-
-    case "additional-create":
-        $stmt = $db->prepare("INSERT INTO `additionals` (`id`, `prefix`) VALUES (:id, :prefix)");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":prefix", arg("prefix"));
-        $stmt->execute();
-        respond();
+        $directories[$row["id"]] = ["dirs" => (object) $content["dirs"], "files" => (object) $content["files"]];
+    }
 
-    case "additional-delete":
-        $stmt = $db->prepare("DELETE FROM `additionals` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->execute();
-        respond();
-
-    case "additional-exists":
-        $stmt = $db->prepare("SELECT COUNT(*) FROM `additionals` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        respond($result->fetchArray()[0] > 0);
-
-    case "additional-list":
-        $stmt = $db->prepare("SELECT `id`, `version` FROM `additionals`");
-        $result = $stmt->execute();
-        $additionals = [];
-        while ($row = $result->fetchArray(SQLITE3_ASSOC)) $additionals[$row["id"]] = $row["version"];
-        respond($additionals);
-
-    case "additional-set-content":
-        $stmt = $db->prepare("UPDATE `additionals` SET `content` = :content, `version` = :version WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":content", json_encode(arg("content")));
-        $stmt->bindValue(":version", arg("version"));
+    foreach ($directories as $id => $content) {
+        $stmt = $db->prepare("UPDATE `directories` SET `content` = :content WHERE `id` = :id");
+        $stmt->bindValue(":id", $id);
+        $stmt->bindValue(":content", json_encode($content));
         $stmt->execute();
-        respond();
-
-    case "additional-set-meta":
-        $stmt = $db->prepare("UPDATE `additionals` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $stmt->bindValue(":owner", arg("owner"));
-        $stmt->bindValue(":group", arg("group"));
-        $stmt->bindValue(":mode", arg("mode"));
-        $stmt->execute();
-        respond();
-
-    case "additional-get-prefix":
-        $stmt = $db->prepare("SELECT `prefix` FROM `additionals` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond($row["prefix"]);
-
-    case "additional-get-content":
-        $stmt = $db->prepare("SELECT `content` FROM `additionals` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond(json_decode($row["content"], true));
-
-    case "additional-get-meta":
-        $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `additionals` WHERE `id` = :id");
-        $stmt->bindValue(":id", arg("id"));
-        $result = $stmt->execute();
-        $row = $result->fetchArray(SQLITE3_ASSOC);
-        respond($row);
-
-    default:
-        error("Invalid action: " . arg("action"));
+    }
+});
+
+migrate(2, function () {
+    global $db;
+
+    $db->exec("CREATE TABLE `changes` (
+        `revision` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `type` TEXT,
+        `id` TEXT,
+        UNIQUE (`type`, `id`)
+    )");
+
+    foreach (["files", "directories", "packages", "partials", "additionals"] as $type)
+        $db->exec("INSERT INTO `changes` (`type`, `id`) SELECT '$type', `id` FROM `$type`");
+});
+
+migrate(3, function () {
+    global $db;
+
+    $db->exec("CREATE TABLE `builds` (
+        `name` TEXT,
+        `version` TEXT,
+        `arch` TEXT,
+        `file` TEXT,
+        `hash` TEXT,
+        `created` INTEGER,
+        PRIMARY KEY (`name`, `version`, `arch`)
+    )");
+});
+
+migrate(4, function () {
+    global $db;
+
+    $db->exec("ALTER TABLE `packages` ADD COLUMN `source` TEXT DEFAULT NULL");
+});
+
+function run($request) {
+    global $data, $db, $BATCH, $CHANGED;
+    $data = $request;
+
+    switch (arg("action")) {
+        case "check":
+            return true;
+
+        case "batch":
+            $results = [];
+            $BATCH = true;
+            $db->exec("BEGIN IMMEDIATE");
+            foreach (arg("actions") as $group) {
+                $actions = is_array($group) && array_is_list($group) ? $group : [$group];
+                $db->exec("SAVEPOINT `group`");
+
+                try {
+                    $done = [];
+                    foreach ($actions as $action) {
+                        if (!is_array($action) || ($action["action"] ?? null) === "batch") error("Invalid batch action");
+                        $done[] = ["good" => true, "data" => run($action)];
+                    }
+
+                    $db->exec("RELEASE `group`");
+                } catch (ActionError $e) {
+                    $db->exec("ROLLBACK TO `group`");
+                    $db->exec("RELEASE `group`");
+                    $done = array_fill(0, count($actions), ["good" => false, "error" => $e->getMessage()]);
+                }
+
+                $results[] = is_array($group) && array_is_list($group) ? $done : $done[0];
+            }
+
+            $db->exec("COMMIT");
+            $BATCH = false;
+            if ($CHANGED) touch("/data/changes");
+            return $results;
+
+        case "blob-missing":
+            $missing = [];
+            foreach (arg("hashes") as $hash) {
+                if (file_exists(blob_path($hash))) touch(blob_path($hash));
+                else $missing[] = $hash;
+            }
+
+            return $missing;
+
+        case "blob-signature":
+            $path = blob_path(arg("hash"));
+            if (!file_exists($path)) error("Missing blob: " . arg("hash"));
+            if (!is_int(arg("block")) || arg("block") < 1024 || arg("block") > 1 << 20) error("Invalid block size");
+
+            $in = fopen($path, "rb");
+            $blocks = [];
+            while (($chunk = fread($in, arg("block"))) !== false && $chunk !== "") {
+                $blocks[] = [hexdec(hash("adler32", $chunk)), hash("md5", $chunk)];
+            }
+
+            fclose($in);
+            return ["size" => filesize($path), "blocks" => $blocks];
+
+        case "upload-begin":
+            if (!is_int(arg("size")) || arg("size") < 0 || !is_int(arg("chunk")) || arg("chunk") <= 0) error("Invalid upload");
+
+            $dir = upload_path(arg("hash"));
+            $info = ["size" => arg("size"), "chunk" => arg("chunk")];
+            if (is_dir($dir) && json_decode(@file_get_contents("$dir/info"), true) !== $info) upload_clear($dir);
+
+            if (!is_dir($dir)) {
+                mkdir($dir);
+                file_put_contents("$dir/info", json_encode($info));
+            }
+
+            touch($dir);
+            $chunks = [];
+            foreach (scandir($dir) as $name) if (ctype_digit($name)) $chunks[] = (int) $name;
+
+            return ["session" => arg("hash"), "chunks" => $chunks];
+
+        case "upload-finish":
+            $dir = upload_path(arg("session"));
+            $path = blob_path(arg("session"));
+
+            if (!file_exists($path)) {
+                $info = json_decode(@file_get_contents("$dir/info"), true);
+                if (!$info) error("Invalid session: " . arg("session"));
+
+                $out = fopen("$path." . getmypid(), "wb");
+                $hash = hash_init("sha256");
+                for ($i = 0; $i < ceil($info["size"] / $info["chunk"]); $i++) {
+                    $in = @fopen("$dir/$i", "rb");
+                    if ($in === false) {
+                        fclose($out);
+                        unlink("$path." . getmypid());
+                        error("Missing chunk: $i");
+                    }
+
+                    while (!feof($in)) {
+                        $chunk = fread($in, 1 << 16);
+                        hash_update($hash, $chunk);
+                        fwrite($out, $chunk);
+                    }
+
+                    fclose($in);
+                }
+
+                fclose($out);
+
+                if (hash_final($hash) !== arg("session")) {
+                    unlink("$path." . getmypid());
+                    upload_clear($dir);
+                    error("Hash mismatch: " . arg("session"));
+                }
+
+                rename("$path." . getmypid(), $path);
+            }
+
+            if (is_dir($dir)) upload_clear($dir);
+            return true;
+
+        case "changes-wait":
+            if (arg("revision") > revision()) return ["revision" => revision(), "changes" => []];
+
+            $deadline = time() + min(arg("timeout"), 50);
+            $stmt = $db->prepare("SELECT `type`, `id`, `revision` FROM `changes` WHERE `revision` > :revision ORDER BY `revision`");
+            $stmt->bindValue(":revision", arg("revision"));
+
+            $checked = 0;
+            $changes = [];
+            $revision = arg("revision");
+
+            do {
+                clearstatcache(true, "/data/changes");
+                if (@filemtime("/data/changes") >= $checked) {
+                    $checked = time();
+                    $result = $stmt->execute();
+                    while ($row = $result->fetchArray(SQLITE3_ASSOC)) {
+                        $changes[] = [$row["type"], $row["id"]];
+                        $revision = $row["revision"];
+                    }
+
+                    $result->finalize();
+                    if (count($changes) > 0) break;
+                }
+
+                usleep(250000);
+            } while (time() < $deadline);
+
+            return ["revision" => $revision, "changes" => $changes];
+
+        case "sync-manifest":
+            $revision = revision();
+
+            $files = [];
+            $result = $db->query("SELECT `id`, `version`, `hash`, `owner`, `group`, `mode` FROM `files`");
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $files[$row["id"]] = $row;
+
+            $directories = [];
+            $result = $db->query("SELECT `id`, `version`, `owner`, `group`, `mode` FROM `directories`");
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $directories[$row["id"]] = $row;
+
+            $packages = [];
+            $result = $db->query("SELECT `id`, `source` FROM `packages`");
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $packages[$row["id"]] = $row;
+
+            $partials = [];
+            $result = $db->query("SELECT `id`, `version`, `content`, `owner`, `group`, `mode` FROM `partials`");
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $partials[$row["id"]] = array_merge($row, ["content" => json_decode($row["content"], true)]);
+
+            $additionals = [];
+            $result = $db->query("SELECT `id`, `version`, `prefix`, `owner`, `group`, `mode` FROM `additionals`");
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $additionals[$row["id"]] = $row;
+
+            return [
+                "revision" => $revision,
+                "files" => (object) $files,
+                "directories" => (object) $directories,
+                "packages" => (object) $packages,
+                "partials" => (object) $partials,
+                "additionals" => (object) $additionals,
+            ];
+
+        case "build-list":
+            $builds = [];
+            $stmt = $db->prepare("SELECT `name`, `version`, `arch`, `file`, `hash` FROM `builds` WHERE `name` = :name AND `version` = :version AND `arch` IN (:arch, 'any') ORDER BY `created` DESC LIMIT 1");
+            foreach (arg("versions") as $name => $version) {
+                $stmt->bindValue(":name", $name);
+                $stmt->bindValue(":version", $version);
+                $stmt->bindValue(":arch", arg("arch"));
+                $result = $stmt->execute();
+                if ($row = $result->fetchArray(SQLITE3_ASSOC)) $builds[$name] = $row;
+                $result->finalize();
+            }
+
+            return (object) $builds;
+
+        case "build-add":
+            if (!file_exists(blob_path(arg("hash")))) error("Missing blob: " . arg("hash"));
+            if (!preg_match("/^[A-Za-z0-9@._+:-]+\.pkg\.tar\.[a-z0-9]+$/", arg("file"))) error("Invalid file: " . arg("file"));
+
+            $stmt = $db->prepare("INSERT OR REPLACE INTO `builds` (`name`, `version`, `arch`, `file`, `hash`, `created`) VALUES (:name, :version, :arch, :file, :hash, :created)");
+            $stmt->bindValue(":name", arg("name"));
+            $stmt->bindValue(":version", arg("version"));
+            $stmt->bindValue(":arch", arg("arch"));
+            $stmt->bindValue(":file", arg("file"));
+            $stmt->bindValue(":hash", arg("hash"));
+            $stmt->bindValue(":created", time());
+            $stmt->execute();
+
+            $stmt = $db->prepare("DELETE FROM `builds` WHERE `name` = :name AND `arch` = :arch AND `version` != :version");
+            $stmt->bindValue(":name", arg("name"));
+            $stmt->bindValue(":arch", arg("arch"));
+            $stmt->bindValue(":version", arg("version"));
+            $stmt->execute();
+            blob_gc();
+            return null;
+
+        case "file-create":
+            $stmt = $db->prepare("INSERT INTO `files` (`id`) VALUES (:id)");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("files");
+            return null;
+
+        case "file-delete":
+            $stmt = $db->prepare("DELETE FROM `files` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("files");
+            return null;
+
+        case "file-exists":
+            $stmt = $db->prepare("SELECT COUNT(*) FROM `files` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            return $result->fetchArray()[0] > 0;
+
+        case "file-list":
+            $stmt = $db->prepare("SELECT `id`, `version` FROM `files`");
+            $result = $stmt->execute();
+            $files = [];
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $files[$row["id"]] = $row["version"];
+            return $files;
+
+        case "file-set-content":
+            $hash = array_key_exists("content", $data) ? blob_put(base64_decode(arg("content"))) : arg("hash");
+            if (!file_exists(blob_path($hash))) error("Missing blob: $hash");
+
+            $stmt = $db->prepare("UPDATE `files` SET `hash` = :hash, `version` = :version WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":hash", $hash);
+            $stmt->bindValue(":version", arg("version"));
+            $stmt->execute();
+            changed("files");
+            blob_gc();
+            return null;
+
+        case "file-set-meta":
+            $stmt = $db->prepare("UPDATE `files` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":owner", arg("owner"));
+            $stmt->bindValue(":group", arg("group"));
+            $stmt->bindValue(":mode", arg("mode"));
+            $stmt->execute();
+            changed("files");
+            return null;
+
+        case "file-get-content":
+            $stmt = $db->prepare("SELECT `hash` FROM `files` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return $row && $row["hash"] ? base64_encode(file_get_contents(blob_path($row["hash"]))) : "";
+
+        case "file-get-meta":
+            $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `files` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return $row;
+
+        case "directory-create":
+            $stmt = $db->prepare("INSERT INTO `directories` (`id`) VALUES (:id)");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("directories");
+            return null;
+
+        case "directory-delete":
+            $stmt = $db->prepare("DELETE FROM `directories` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("directories");
+            return null;
+
+        case "directory-exists":
+            $stmt = $db->prepare("SELECT COUNT(*) FROM `directories` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            return $result->fetchArray()[0] > 0;
+
+        case "directory-list":
+            $stmt = $db->prepare("SELECT `id`, `version` FROM `directories`");
+            $result = $stmt->execute();
+            $directories = [];
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $directories[$row["id"]] = $row["version"];
+            return $directories;
+
+        case "directory-set-content":
+            $content = arg("content");
+            foreach ($content["files"] as $file => $entry) {
+                if (array_key_exists("content", $entry)) {
+                    $content["files"][$file]["hash"] = blob_put(base64_decode($entry["content"]));
+                    unset($content["files"][$file]["content"]);
+                } else if (!file_exists(blob_path($entry["hash"] ?? null))) {
+                    error("Missing blob: " . $entry["hash"]);
+                }
+            }
+
+            $stmt = $db->prepare("UPDATE `directories` SET `content` = :content, `version` = :version WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":content", json_encode(["dirs" => (object) $content["dirs"], "files" => (object) $content["files"]]));
+            $stmt->bindValue(":version", arg("version"));
+            $stmt->execute();
+            changed("directories");
+            blob_gc();
+            return null;
+
+        case "directory-patch-content":
+            foreach (arg("set")["files"] as $entry)
+                if (!file_exists(blob_path($entry["hash"] ?? null))) error("Missing blob: " . $entry["hash"]);
+
+            $stmt = $db->prepare("SELECT `content` FROM `directories` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            if (!$row) error("Unknown directory: " . arg("id"));
+
+            $content = json_decode($row["content"], true);
+            foreach (["dirs", "files"] as $type) {
+                foreach (arg("delete")[$type] as $path) unset($content[$type][$path]);
+                foreach (arg("set")[$type] as $path => $entry) $content[$type][$path] = $entry;
+            }
+
+            $stmt = $db->prepare("UPDATE `directories` SET `content` = :content, `version` = :version WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":content", json_encode(["dirs" => (object) $content["dirs"], "files" => (object) $content["files"]]));
+            $stmt->bindValue(":version", arg("version"));
+            $stmt->execute();
+            changed("directories");
+            blob_gc();
+            return null;
+
+        case "directory-set-meta":
+            $stmt = $db->prepare("UPDATE `directories` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":owner", arg("owner"));
+            $stmt->bindValue(":group", arg("group"));
+            $stmt->bindValue(":mode", arg("mode"));
+            $stmt->execute();
+            changed("directories");
+            return null;
+
+        case "directory-get-content":
+            $stmt = $db->prepare("SELECT `content` FROM `directories` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            if (!$row) error("Unknown directory: " . arg("id"));
+
+            $content = json_decode($row["content"], true);
+            foreach ($content["files"] as $file => $entry)
+                $content["files"][$file]["content"] = base64_encode(file_get_contents(blob_path($entry["hash"])));
+
+            return ["dirs" => (object) $content["dirs"], "files" => (object) $content["files"]];
+
+        case "directory-get-entries":
+            $stmt = $db->prepare("SELECT `content` FROM `directories` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return json_decode($row["content"], true);
+
+        case "directory-get-meta":
+            $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `directories` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return $row;
+
+        case "package-add":
+            $stmt = $db->prepare("INSERT INTO `packages` (`id`) VALUES (:id)");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("packages");
+            return null;
+
+        case "package-remove":
+            $stmt = $db->prepare("DELETE FROM `packages` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("packages");
+            return null;
+
+        case "package-set-source":
+            if (!in_array(arg("source"), ["repo", "aur", null], true)) error("Invalid source: " . arg("source"));
+
+            $stmt = $db->prepare("UPDATE `packages` SET `source` = :source WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":source", arg("source"));
+            $stmt->execute();
+            return null;
+
+        case "package-exists":
+            $stmt = $db->prepare("SELECT COUNT(*) FROM `packages` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            return $result->fetchArray()[0] > 0;
+
+        case "package-list":
+            $stmt = $db->prepare("SELECT `id` FROM `packages`");
+            $result = $stmt->execute();
+            $packages = [];
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $packages[] = $row["id"];
+            return $packages;
+
+        case "partial-create":
+            $stmt = $db->prepare("INSERT INTO `partials` (`id`) VALUES (:id)");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("partials");
+            return null;
+
+        case "partial-delete":
+            $stmt = $db->prepare("DELETE FROM `partials` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("partials");
+            return null;
+
+        case "partial-exists":
+            $stmt = $db->prepare("SELECT COUNT(*) FROM `partials` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            return $result->fetchArray()[0] > 0;
+
+        case "partial-list":
+            $stmt = $db->prepare("SELECT `id`, `version` FROM `partials`");
+            $result = $stmt->execute();
+            $partials = [];
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $partials[$row["id"]] = $row["version"];
+            return $partials;
+
+        case "partial-set-content":
+            $stmt = $db->prepare("UPDATE `partials` SET `content` = :content, `version` = :version WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":content", json_encode(arg("content")));
+            $stmt->bindValue(":version", arg("version"));
+            $stmt->execute();
+            changed("partials");
+            return null;
+
+        case "partial-set-meta":
+            $stmt = $db->prepare("UPDATE `partials` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":owner", arg("owner"));
+            $stmt->bindValue(":group", arg("group"));
+            $stmt->bindValue(":mode", arg("mode"));
+            $stmt->execute();
+            changed("partials");
+            return null;
+
+        case "partial-get-content":
+            $stmt = $db->prepare("SELECT `content` FROM `partials` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return json_decode($row["content"], true);
+
+        case "partial-get-meta":
+            $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `partials` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return $row;
+
+        case "additional-create":
+            $stmt = $db->prepare("INSERT INTO `additionals` (`id`, `prefix`) VALUES (:id, :prefix)");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":prefix", arg("prefix"));
+            $stmt->execute();
+            changed("additionals");
+            return null;
+
+        case "additional-delete":
+            $stmt = $db->prepare("DELETE FROM `additionals` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->execute();
+            changed("additionals");
+            return null;
+
+        case "additional-exists":
+            $stmt = $db->prepare("SELECT COUNT(*) FROM `additionals` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            return $result->fetchArray()[0] > 0;
+
+        case "additional-list":
+            $stmt = $db->prepare("SELECT `id`, `version` FROM `additionals`");
+            $result = $stmt->execute();
+            $additionals = [];
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) $additionals[$row["id"]] = $row["version"];
+            return $additionals;
+
+        case "additional-set-content":
+            $stmt = $db->prepare("UPDATE `additionals` SET `content` = :content, `version` = :version WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":content", json_encode(arg("content")));
+            $stmt->bindValue(":version", arg("version"));
+            $stmt->execute();
+            changed("additionals");
+            return null;
+
+        case "additional-set-meta":
+            $stmt = $db->prepare("UPDATE `additionals` SET `owner` = :owner, `group` = :group, `mode` = :mode WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $stmt->bindValue(":owner", arg("owner"));
+            $stmt->bindValue(":group", arg("group"));
+            $stmt->bindValue(":mode", arg("mode"));
+            $stmt->execute();
+            changed("additionals");
+            return null;
+
+        case "additional-get-prefix":
+            $stmt = $db->prepare("SELECT `prefix` FROM `additionals` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return $row["prefix"];
+
+        case "additional-get-content":
+            $stmt = $db->prepare("SELECT `content` FROM `additionals` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return json_decode($row["content"], true);
+
+        case "additional-get-meta":
+            $stmt = $db->prepare("SELECT `version`, `owner`, `group`, `mode` FROM `additionals` WHERE `id` = :id");
+            $stmt->bindValue(":id", arg("id"));
+            $result = $stmt->execute();
+            $row = $result->fetchArray(SQLITE3_ASSOC);
+            return $row;
+
+        default:
+            error("Invalid action: " . arg("action"));
+    }
 }
+
+function stream($request) {
+    global $data, $GZIP, $ENCODING;
+    $data = $request;
+
+    switch (arg("action")) {
+        case "blob-upload":
+            $path = blob_path(arg("hash"));
+            $in = fopen("php://input", "rb");
+            $out = fopen("$path." . getmypid(), "wb");
+            $hash = hash_init("sha256");
+            if ($ENCODING === "gzip") stream_filter_append($in, "zlib.inflate", STREAM_FILTER_READ, ["window" => 31]);
+
+            while (!feof($in)) {
+                $chunk = fread($in, 1 << 16);
+                hash_update($hash, $chunk);
+                fwrite($out, $chunk);
+            }
+
+            fclose($in);
+            fclose($out);
+
+            if (hash_final($hash) !== arg("hash")) {
+                unlink("$path." . getmypid());
+                error("Hash mismatch: " . arg("hash"));
+            }
+
+            rename("$path." . getmypid(), $path);
+            return true;
+
+        case "upload-chunk":
+            $dir = upload_path(arg("session"));
+            if (!is_file("$dir/info")) error("Invalid session: " . arg("session"));
+            if (!ctype_digit(arg("index"))) error("Invalid chunk: " . arg("index"));
+            if (!preg_match("/^[0-9a-f]{64}$/", arg("hash"))) error("Invalid hash");
+
+            $path = "$dir/" . (int) arg("index");
+            $in = fopen("php://input", "rb");
+            $out = fopen("$path." . getmypid(), "wb");
+            $hash = hash_init("sha256");
+            if ($ENCODING === "gzip") stream_filter_append($in, "zlib.inflate", STREAM_FILTER_READ, ["window" => 31]);
+
+            while (!feof($in)) {
+                $chunk = fread($in, 1 << 16);
+                hash_update($hash, $chunk);
+                fwrite($out, $chunk);
+            }
+
+            fclose($in);
+            fclose($out);
+
+            if (hash_final($hash) !== arg("hash")) {
+                unlink("$path." . getmypid());
+                error("Hash mismatch: " . arg("hash"));
+            }
+
+            rename("$path." . getmypid(), $path);
+            touch($dir);
+            return true;
+
+        case "blob-patch":
+            $base = blob_path(arg("base"));
+            $path = blob_path(arg("hash"));
+            $block = (int) arg("block");
+            if (!file_exists($base)) error("Missing blob: " . arg("base"));
+            if ($block < 1024 || $block > 1 << 20) error("Invalid block size");
+
+            $in = fopen("php://input", "rb");
+            $source = fopen($base, "rb");
+            $out = fopen("$path." . getmypid(), "wb");
+            $hash = hash_init("sha256");
+            if ($ENCODING === "gzip") stream_filter_append($in, "zlib.inflate", STREAM_FILTER_READ, ["window" => 31]);
+
+            while (($line = fgets($in)) !== false) {
+                $op = explode(" ", rtrim($line, "\n"));
+                if ($op[0] === "C" && count($op) === 3 && ctype_digit($op[1]) && ctype_digit($op[2])) {
+                    fseek($source, $op[1] * $block);
+                    $stream = $source;
+                    $size = $op[2] * $block;
+                } else if ($op[0] === "L" && count($op) === 2 && ctype_digit($op[1])) {
+                    $stream = $in;
+                    $size = (int) $op[1];
+                } else {
+                    fclose($out);
+                    unlink("$path." . getmypid());
+                    error("Invalid patch");
+                }
+
+                while ($size > 0 && !feof($stream)) {
+                    $chunk = fread($stream, min(1 << 16, $size));
+                    if ($chunk === false) break;
+
+                    $size -= strlen($chunk);
+                    hash_update($hash, $chunk);
+                    fwrite($out, $chunk);
+                }
+            }
+
+            fclose($in);
+            fclose($source);
+            fclose($out);
+
+            if (hash_final($hash) !== arg("hash")) {
+                unlink("$path." . getmypid());
+                error("Hash mismatch: " . arg("hash"));
+            }
+
+            rename("$path." . getmypid(), $path);
+            return true;
+
+        case "blob-blocks":
+            $path = blob_path(arg("hash"));
+            $block = (int) arg("block");
+            if (!file_exists($path)) error("Missing blob: " . arg("hash"));
+            if ($block < 1024 || $block > 1 << 20) error("Invalid block size");
+
+            $ranges = [];
+            foreach (explode(",", arg("ranges")) as $range) {
+                $bounds = explode("-", $range);
+                if (count($bounds) !== 2 || !ctype_digit($bounds[0]) || !ctype_digit($bounds[1])) error("Invalid range: $range");
+                $ranges[] = [(int) $bounds[0], (int) $bounds[1]];
+            }
+
+            $in = fopen($path, "rb");
+            header("Content-Type: application/octet-stream");
+
+            foreach ($ranges as [$start, $end]) {
+                fseek($in, $start * $block);
+                $size = ($end - $start + 1) * $block;
+                while ($size > 0 && !feof($in)) {
+                    $chunk = fread($in, min(1 << 16, $size));
+                    if ($chunk === false) break;
+
+                    $size -= strlen($chunk);
+                    print($chunk);
+                }
+            }
+
+            exit();
+
+        case "blob-archive":
+            $in = fopen("php://input", "rb");
+            if ($ENCODING === "gzip") stream_filter_append($in, "zlib.inflate", STREAM_FILTER_READ, ["window" => 31]);
+
+            $count = 0;
+            while (($line = fgets($in)) !== false) {
+                $header = explode(" ", rtrim($line, "\n"));
+                if (count($header) !== 2 || !ctype_digit($header[1])) error("Invalid archive");
+
+                $path = blob_path($header[0]);
+                $size = (int) $header[1];
+                $out = fopen("$path." . getmypid(), "wb");
+                $hash = hash_init("sha256");
+
+                while ($size > 0 && !feof($in)) {
+                    $chunk = fread($in, min(1 << 16, $size));
+                    if ($chunk === false) break;
+
+                    $size -= strlen($chunk);
+                    hash_update($hash, $chunk);
+                    fwrite($out, $chunk);
+                }
+
+                fclose($out);
+
+                if ($size > 0 || hash_final($hash) !== $header[0]) {
+                    unlink("$path." . getmypid());
+                    error("Hash mismatch: " . $header[0]);
+                }
+
+                rename("$path." . getmypid(), $path);
+                $count++;
+            }
+
+            fclose($in);
+            return $count;
+
+        case "blob-download":
+            $path = blob_path(arg("hash"));
+            if (!file_exists($path)) error("Missing blob: " . arg("hash"));
+
+            $in = fopen($path, "rb");
+            $offset = (int) ($data["offset"] ?? 0);
+            if ($offset < 0 || $offset > filesize($path)) $offset = 0;
+
+            $compress = $GZIP && filesize($path) - $offset >= 1024 && compressible($in);
+            fseek($in, $offset);
+            header("Content-Type: application/octet-stream");
+
+            if ($compress) {
+                header("Content-Encoding: gzip");
+                stream_filter_append($in, "zlib.deflate", STREAM_FILTER_READ, ["window" => 31, "level" => 6]);
+            } else {
+                header("Content-Length: " . (filesize($path) - $offset));
+            }
+
+            fpassthru($in);
+            exit();
+
+        default:
+            error("Invalid action: " . arg("action"));
+    }
+}
+
+respond($RAW ? stream($data) : run($data));
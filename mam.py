@@ -1,20 +1,76 @@
 #!/usr/bin/env python3
 
 import base64
+import ctypes
+import errno
+import fcntl
+import glob
+import hashlib
+import http.client
+import io
 import json
+import mmap
 import os
+import queue
 import re
+import select
 import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
+import threading
+import time
+import urllib.parse
 import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from getpass import getpass
-from typing import Any, TypeVar
+from stat import S_ISDIR, S_ISREG
+from typing import Any, BinaryIO, Callable, Iterator, TypeVar
 
 T = TypeVar("T")
 
 DIR = "/var/lib/mam"
 CONFIG = {"address": "http://localhost", "password": ""}
+QUEUE: list[list[tuple[dict, Callable[[Any], None] | None]]] = []
+BATCH_SIZE = 64
+JOBS = 8
+LOCK = threading.RLock()
+CHUNK_SIZE = 1 << 16
+COMPRESS_THRESHOLD = 1 << 10
+TRANSFER_CHUNK = 4 << 20
+TRANSFERS: dict[str, threading.Lock] = {}
+DELTA_THRESHOLD = 1 << 16
+DELTA_ROLL = 1 << 20
+DELTA_RANGES = 256
+POOL: list[http.client.HTTPConnection] = []
+ACCEPTED: set[str] = set()
+STATS = {"requests": 0, "connections": 0, "bytes": 0, "wire": 0, "failed": 0}
+INSTALLED: dict[str, str] | None = None
+PROVIDED: dict[str, str] | None = None
+SCANS: dict[str, tuple[dict, set[str], dict]] = {}
+LIBC = ctypes.CDLL(None, use_errno=True)
+FICLONE = 0x40049409
+AT_FDCWD = -100
+RENAME_EXCHANGE = 0x2
+WATCH_DEBOUNCE = 2
+WATCH_SETTLE = 30
+WATCH_RECONCILE = 600
+WATCH_POLL = 50
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
 
 
 def b32e(s: str) -> str:
@@ -25,12 +81,13 @@ def b32d(s: str) -> str:
     return base64.b32decode(s.encode()).decode()
 
 
-def b64e(b: bytes) -> str:
-    return base64.b64encode(b).decode()
+def sha256(path: str) -> str:
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            hash.update(chunk)
 
-
-def b64d(s: str) -> bytes:
-    return base64.b64decode(s.encode())
+    return hash.hexdigest()
 
 
 def date(timestamp: int = int(datetime.now().timestamp())) -> str:
@@ -50,6 +107,234 @@ def json_write(path: str, data: object):
         json.dump(data, f)
 
 
+def database() -> sqlite3.Connection:
+    db = sqlite3.connect(f"{DIR}/state.db", check_same_thread=False)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS objects (
+            type TEXT,
+            id TEXT,
+            local INTEGER DEFAULT 0,
+            remote INTEGER DEFAULT 0,
+            data TEXT DEFAULT '{}',
+            PRIMARY KEY (type, id)
+        );
+        CREATE TABLE IF NOT EXISTS backups (
+            type TEXT,
+            id TEXT,
+            data TEXT DEFAULT '{}',
+            PRIMARY KEY (type, id)
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id TEXT PRIMARY KEY,
+            data TEXT
+        );
+        CREATE TABLE IF NOT EXISTS created_dirs (
+            path TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS syncs (
+            start INTEGER PRIMARY KEY,
+            end INTEGER,
+            requests INTEGER,
+            connections INTEGER,
+            bytes INTEGER,
+            wire INTEGER
+        );
+        """
+    )
+
+    if not "data" in [row[1] for row in db.execute("PRAGMA table_info(backups)")]:
+        db.execute("ALTER TABLE backups ADD COLUMN data TEXT DEFAULT '{}'")
+
+    if db.execute("PRAGMA user_version").fetchone()[0] < 1:
+        db.execute("DELETE FROM snapshots")
+        db.execute("PRAGMA user_version = 1")
+        db.commit()
+
+    if os.path.isdir(f"{DIR}/objects"):
+        for type in ["files", "directories", "packages", "partials", "additionals"]:
+            for obj in os.listdir(f"{DIR}/objects/{type}"):
+                state = json_read(f"{DIR}/objects/{type}/{obj}", {}) if type != "packages" else {}
+                data = {key: state[key] for key in state if not key in ["local", "remote"]}
+                db.execute(
+                    "INSERT OR REPLACE INTO objects (type, id, local, remote, data) VALUES (?, ?, ?, ?, ?)",
+                    (type, obj, state.get("local", 0), state.get("remote", 0), json.dumps(data)),
+                )
+
+            for obj in os.listdir(f"{DIR}/backups/{type}"):
+                db.execute("INSERT OR IGNORE INTO backups (type, id) VALUES (?, ?)", (type, obj))
+                if type == "packages":
+                    os.remove(f"{DIR}/backups/packages/{obj}")
+
+        for dir in json_read(f"{DIR}/objects/created_dirs", []):
+            db.execute("INSERT OR IGNORE INTO created_dirs (path) VALUES (?)", (dir,))
+
+        db.commit()
+        shutil.rmtree(f"{DIR}/objects")
+        if os.path.isfile(f"{DIR}/state"):
+            os.remove(f"{DIR}/state")
+
+    return db
+
+
+def query(sql: str, params: tuple = ()) -> list[tuple]:
+    with LOCK:
+        return DB.execute(sql, params).fetchall()
+
+
+def state_list(type: str) -> list[str]:
+    return [row[0] for row in query("SELECT id FROM objects WHERE type = ?", (type,))]
+
+
+def state_read(type: str, obj: str) -> dict:
+    rows = query("SELECT local, remote, data FROM objects WHERE type = ? AND id = ?", (type, obj))
+    if len(rows) == 0:
+        return {"local": 0, "remote": 0}
+
+    return {"local": rows[0][0], "remote": rows[0][1], **json.loads(rows[0][2])}
+
+
+def commit(sql: str, params: tuple = ()):
+    with LOCK:
+        DB.execute(sql, params)
+        DB.commit()
+
+
+def state_write(type: str, obj: str, state: dict):
+    data = {key: state[key] for key in state if not key in ["local", "remote"]}
+    commit(
+        "INSERT OR REPLACE INTO objects (type, id, local, remote, data) VALUES (?, ?, ?, ?, ?)",
+        (type, obj, state.get("local", 0), state.get("remote", 0), json.dumps(data)),
+    )
+
+
+def state_delete(type: str, obj: str):
+    commit("DELETE FROM objects WHERE type = ? AND id = ?", (type, obj))
+
+
+def backup_exists(type: str, obj: str) -> bool:
+    return query("SELECT COUNT(*) FROM backups WHERE type = ? AND id = ?", (type, obj))[0][0] > 0
+
+
+def backup_read(type: str, obj: str) -> dict | None:
+    rows = query("SELECT data FROM backups WHERE type = ? AND id = ?", (type, obj))
+    return json.loads(rows[0][0]) if len(rows) > 0 else None
+
+
+def backup_add(type: str, obj: str, data: dict = {}):
+    commit("INSERT OR IGNORE INTO backups (type, id, data) VALUES (?, ?, ?)", (type, obj, json.dumps(data)))
+
+
+def backup_delete(type: str, obj: str):
+    commit("DELETE FROM backups WHERE type = ? AND id = ?", (type, obj))
+
+
+def backup_hashes(type: str, obj: str) -> set[str]:
+    hashes = set()
+    for (data,) in query("SELECT data FROM backups WHERE type != ? OR id != ?", (type, obj)):
+        data = json.loads(data)
+        if "hash" in data:
+            hashes.add(data["hash"])
+
+        hashes.update(entry["hash"] for entry in data.get("files", {}).values())
+
+    return hashes
+
+
+def backups_prune():
+    hashes = backup_hashes("", "")
+    for path in glob.glob(f"{DIR}/backups/blobs/*"):
+        if not os.path.basename(path) in hashes:
+            os.remove(path)
+
+
+def backup_blob(path: str) -> dict:
+    os.makedirs(f"{DIR}/backups/blobs", 0o700, exist_ok=True)
+    tmp = f"{DIR}/backups/blobs/.{threading.get_ident()}"
+    hash = hashlib.sha256()
+    with open(path, "rb") as src, file_create(tmp) as dst:
+        stat = os.fstat(src.fileno())
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            while chunk := src.read(1 << 20):
+                hash.update(chunk)
+        except OSError:
+            while chunk := src.read(1 << 20):
+                hash.update(chunk)
+                dst.write(chunk)
+
+    blob = f"{DIR}/backups/blobs/{hash.hexdigest()}"
+    if os.path.isfile(blob):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, blob)
+
+    return {
+        "hash": hash.hexdigest(),
+        "owner": stat.st_uid,
+        "group": stat.st_gid,
+        "mode": stat.st_mode,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+def backup_restore(entry: dict, path: str, keep: bool):
+    blob = f"{DIR}/backups/blobs/{entry['hash']}"
+    if keep:
+        file_clone(blob, path)
+    else:
+        try:
+            os.replace(blob, path)
+        except OSError:
+            file_clone(blob, path)
+            os.remove(blob)
+
+    os.chown(path, entry["owner"], entry["group"])
+    os.chmod(path, entry["mode"])
+    os.utime(path, ns=(entry["mtime"], entry["mtime"]))
+
+
+def backup_file(type: str, obj: str):
+    path = b32d(obj)
+    if not os.path.isfile(path) or backup_exists(type, obj):
+        return
+
+    backup_add(type, obj, backup_blob(path))
+
+
+def backup_file_restore(type: str, obj: str):
+    path = b32d(obj)
+    if os.path.isfile(path):
+        os.remove(path)
+
+    backup = backup_read(type, obj)
+    if backup == {}:
+        shutil.move(f"{DIR}/backups/{type}/{obj}", path)
+    elif backup != None:
+        backup_restore(backup, path, backup["hash"] in backup_hashes(type, obj))
+
+    backup_delete(type, obj)
+    state_delete(type, obj)
+
+
+def file_create(path: str, mode: str = "wb") -> BinaryIO:
+    if os.path.lexists(path):
+        os.remove(path)
+
+    flags = os.O_RDWR if "+" in mode else os.O_WRONLY
+    return open(os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o600), mode)
+
+
+def file_clone(source: str, target: str):
+    with open(source, "rb") as src, file_create(target) as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
 def lines_read(path: str) -> list[str]:
     if not os.path.isfile(path):
         return []
@@ -58,46 +343,126 @@ def lines_read(path: str) -> list[str]:
         return f.read().splitlines()
 
 
-def lines_write(path: str, lines: list[str]):
-    with open(path, "w") as f:
-        f.write("\n".join(lines) + "\n")
+def file_read(path: str) -> bytes | mmap.mmap:
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return b""
+
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def file_lines(data: bytes | mmap.mmap) -> list[tuple[int, int, str]]:
+    lines = []
+    start = 0
+    while start < len(data):
+        stop = data.find(b"\n", start)
+        stop = len(data) if stop < 0 else stop
+        end = stop - 1 if stop > start and data[stop - 1] == 13 else stop
+        lines.append((start, end, data[start:end].decode(errors="surrogateescape")))
+        start = stop + 1
+
+    return lines
+
+
+def line_find(data: bytes | mmap.mmap, line: str, start: int = 0) -> tuple[int, int] | None:
+    needle = line.encode(errors="surrogateescape")
+    while (index := data.find(needle, start)) >= 0:
+        stop = index + len(needle)
+        tail = data[stop : stop + 2]
+        if index == 0 or data[index - 1] == 10:
+            if tail.startswith(b"\n"):
+                return index, stop + 1
+            elif tail == b"\r\n":
+                return index, stop + 2
+            elif stop == len(data):
+                return index, stop
+
+        start = index + 1
+
+    return None
+
+
+def file_splice(path: str, data: bytes | mmap.mmap, edits: list[tuple[int, int, bytes]]):
+    edits = [edit for edit in edits if data[edit[0] : edit[1]] != edit[2]]
+    if len(edits) == 0 and os.path.exists(path):
+        return
+
+    target = os.path.realpath(path)
+    temp = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.mam")
+    with file_create(temp) as f, memoryview(data) as view:
+        if os.path.exists(target):
+            stat = os.stat(target)
+            os.fchown(f.fileno(), stat.st_uid, stat.st_gid)
+            os.fchmod(f.fileno(), stat.st_mode)
+
+        offset = 0
+        for start, stop, replacement in sorted(edits):
+            f.write(view[offset:start])
+            f.write(replacement)
+            offset = stop
+
+        f.write(view[offset:])
+
+    if not file_inplace(target):
+        try:
+            os.replace(temp, target)
+            return
+        except OSError as e:
+            if not e.errno in [errno.EBUSY, errno.EXDEV]:
+                os.remove(temp)
+                raise
+
+    with open(temp, "rb") as src, open(target, "r+b") as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        dst.truncate()
+
+    os.remove(temp)
+
+
+def file_inplace(path: str) -> bool:
+    if not os.path.exists(path):
+        return False
+
+    try:
+        return os.stat(path).st_nlink > 1 or len(os.listxattr(path)) > 0
+    except OSError:
+        return False
 
 
 def makedirs(path: str) -> list[str]:
-    dirs = []
-    while not os.path.isdir(path):
-        dirs.insert(0, path)
-        path = os.path.dirname(path)
+    with LOCK:
+        dirs = []
+        while not os.path.isdir(path):
+            dirs.insert(0, path)
+            path = os.path.dirname(path)
 
-    for dir in dirs:
-        os.mkdir(dir)
+        for dir in dirs:
+            os.mkdir(dir)
 
-    return dirs
+        return dirs
 
 
 def handleCreatedDirs(dirs: list[str], owner: int, group: int):
-    created_dirs = json_read(f"{DIR}/objects/created_dirs", [])
     for dir in dirs:
         os.chown(dir, owner, group)
-        if not dir in created_dirs:
-            created_dirs.append(dir)
-
-    json_write(f"{DIR}/objects/created_dirs", created_dirs)
+        query("INSERT OR IGNORE INTO created_dirs (path) VALUES (?)", (dir,))
 
 
 def arg(n: int) -> str | None:
     return sys.argv[n] if len(sys.argv) > n else None
 
 
-def requireAuth():
+def requireAuth(action: str = "check") -> Any:
     if not os.path.isfile(f"{DIR}/config"):
         print("Not configured.")
-    elif not api("check"):
+        sys.exit(1)
+
+    res = api(action)
+    if not res:
         print("Authentication failed.")
-    else:
-        return
+        sys.exit(1)
 
-    sys.exit(1)
+    return res
 
 
 def requireArgs(n: int | list[int], message: str):
@@ -109,15 +474,214 @@ def requireArgs(n: int | list[int], message: str):
         sys.exit(1)
 
 
+def count(key: str, n: int = 1):
+    with LOCK:
+        STATS[key] += n
+
+
+def count_reset():
+    with LOCK:
+        for key in STATS:
+            STATS[key] = 0
+
+
+def connect() -> http.client.HTTPConnection:
+    url = urllib.parse.urlsplit(CONFIG["address"])
+    count("connections")
+
+    if url.scheme == "https":
+        return http.client.HTTPSConnection(url.netloc, timeout=60, blocksize=CHUNK_SIZE)
+
+    return http.client.HTTPConnection(url.netloc, timeout=60, blocksize=CHUNK_SIZE)
+
+
+def compressible(f: BinaryIO) -> bool:
+    sample = f.read(CHUNK_SIZE)
+    f.seek(0)
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.9
+
+
+def compress(f: BinaryIO, sent: dict[str, int]) -> Iterator[bytes]:
+    f.seek(0)
+    compressor = zlib.compressobj(wbits=31)
+    while chunk := f.read(CHUNK_SIZE):
+        sent["bytes"] += len(chunk)
+        chunk = compressor.compress(chunk)
+        sent["wire"] += len(chunk)
+        yield chunk
+
+    chunk = compressor.flush()
+    sent["wire"] += len(chunk)
+    yield chunk
+
+
+def archive(blobs: dict[str, str], compressed: bool, sent: dict[str, int]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31) if compressed else None
+
+    def frame(chunk: bytes) -> bytes:
+        sent["bytes"] += len(chunk)
+        if compressor != None:
+            chunk = compressor.compress(chunk)
+
+        sent["wire"] += len(chunk)
+        return chunk
+
+    for hash, path in blobs.items():
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            yield frame(f"{hash} {size}\n".encode())
+            while size > 0:
+                chunk = f.read(min(CHUNK_SIZE, size)) or bytes(min(CHUNK_SIZE, size))
+                size -= len(chunk)
+                yield frame(chunk)
+
+    if compressor != None:
+        chunk = compressor.flush()
+        sent["wire"] += len(chunk)
+        yield chunk
+
+
+def request(
+    body: bytes | BinaryIO | Callable[[dict[str, int]], Iterator[bytes]],
+    headers: dict,
+    query: dict = {},
+    output: BinaryIO | None = None,
+) -> bytes | None:
+    url = urllib.parse.urlsplit(CONFIG["address"])
+    query = urllib.parse.urlencode(urllib.parse.parse_qsl(url.query) + list(query.items()))
+    path = (url.path or "/") + (f"?{query}" if query else "")
+    headers = {**headers, "User-Agent": "MultiArchManager", "Accept-Encoding": "gzip"}
+
+    while True:
+        with LOCK:
+            conn, reused = (POOL.pop(), True) if len(POOL) > 0 else (None, False)
+
+        if conn == None:
+            conn = connect()
+
+        sent = {"bytes": 0, "wire": 0}
+        try:
+            conn.request("POST", path, body(sent) if callable(body) else body, headers)
+            res = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if reused:
+                if not isinstance(body, bytes) and not callable(body):
+                    body.seek(0)
+
+                continue
+
+            raise
+        except:
+            conn.close()
+            raise
+
+        try:
+            ACCEPTED.update(encoding.strip() for encoding in (res.getheader("Accept-Encoding") or "").split(","))
+            decompressor = zlib.decompressobj(wbits=31) if res.getheader("Content-Encoding") == "gzip" else None
+            streamed = output != None and res.getheader("Content-Type") == "application/octet-stream"
+
+            chunks = []
+            while chunk := res.read(CHUNK_SIZE):
+                count("wire", len(chunk))
+                if decompressor != None:
+                    chunk = decompressor.decompress(chunk)
+
+                count("bytes", len(chunk))
+                if streamed:
+                    output.write(chunk)
+                else:
+                    chunks.append(chunk)
+
+            data = None if streamed else b"".join(chunks)
+        except:
+            conn.close()
+            raise
+
+        count("requests")
+        count("bytes", sent["bytes"])
+        count("wire", sent["wire"])
+        if res.will_close:
+            conn.close()
+        else:
+            with LOCK:
+                POOL.append(conn)
+
+        return data
+
+
 def api(action: str, data: dict = {}) -> Any:
     data["action"] = action
     data["password"] = CONFIG["password"]
 
     try:
-        headers = {"Content-Type": "application/json", "User-Agent": "MultiArchManager"}
-        req = urllib.request.Request(CONFIG["address"], data=json.dumps(data).encode(), headers=headers)
-        res = json.loads(urllib.request.urlopen(req).read().decode())
+        headers = {"Content-Type": "application/json"}
+        body = json.dumps(data).encode()
+        size = len(body)
+
+        if "gzip" in ACCEPTED and len(body) >= COMPRESS_THRESHOLD:
+            headers["Content-Encoding"] = "gzip"
+            body = zlib.compress(body, wbits=31)
+
+        res = request(body, headers)
+        count("bytes", size)
+        count("wire", len(body))
+        res = json.loads(res.decode())
+
+        if res["good"]:
+            return res["data"]
+    except:
+        pass
+
+    return None
+
+
+def api_stream(
+    action: str,
+    data: dict,
+    body: BinaryIO | Callable[[dict[str, int]], Iterator[bytes]] | None = None,
+    output: BinaryIO | None = None,
+    blobs: dict[str, str] | None = None,
+) -> Any:
+    headers = {"Content-Type": "application/octet-stream", "X-Mam-Password": CONFIG["password"]}
+    payload = b""
+    raw = 0
+
+    if blobs != None:
+        compressed = "gzip" in ACCEPTED and sum(os.path.getsize(path) for path in blobs.values()) >= COMPRESS_THRESHOLD
+        if compressed:
+            samples = []
+            for path in blobs.values():
+                with open(path, "rb") as f:
+                    samples.append(compressible(f))
+
+            compressed = sum(samples) * 2 >= len(samples)
+
+        if compressed:
+            headers["Content-Encoding"] = "gzip"
+
+        payload = lambda sent: archive(blobs, compressed, sent)
+    elif callable(body):
+        payload = body
+    elif body != None:
+        size = body.seek(0, os.SEEK_END)
+        body.seek(0)
+        if "gzip" in ACCEPTED and size >= COMPRESS_THRESHOLD and compressible(body):
+            headers["Content-Encoding"] = "gzip"
+            payload = lambda sent: compress(body, sent)
+        else:
+            headers["Content-Length"] = str(size)
+            payload = body
+            raw = size
+
+    try:
+        res = request(payload, headers, {**data, "action": action}, output)
+        count("bytes", raw)
+        count("wire", raw)
+        if res == None:
+            return True
 
+        res = json.loads(res.decode())
         if res["good"]:
             return res["data"]
     except:
@@ -126,6 +690,292 @@ def api(action: str, data: dict = {}) -> Any:
     return None
 
 
+def compressionRatio() -> float:
+    return STATS["bytes"] / STATS["wire"] if STATS["wire"] > 0 else 1
+
+
+def api_queue(action: str, data: dict = {}, callback: Callable[[Any], None] | None = None):
+    api_queue_group([(action, data, callback)])
+
+
+def api_queue_group(calls: list[tuple[str, dict, Callable[[Any], None] | None]]):
+    with LOCK:
+        QUEUE.append([({**data, "action": action}, callback) for action, data, callback in calls])
+
+
+def api_flush():
+    while QUEUE:
+        with LOCK:
+            size = 0
+            groups = 0
+            for group in QUEUE:
+                if groups > 0 and size + len(group) > BATCH_SIZE:
+                    break
+
+                size += len(group)
+                groups += 1
+
+            batch = QUEUE[:groups]
+            del QUEUE[:groups]
+
+        results = api("batch", {"actions": [[data for data, _ in group] for group in batch]})
+        if results is None:
+            count("failed", sum(len(group) for group in batch))
+            continue
+
+        calls = []
+        for group, done in zip(batch, results):
+            for (_, callback), result in zip(group, done):
+                if not result["good"]:
+                    count("failed")
+                elif callback:
+                    calls.append((callback, result["data"]))
+
+        parallel(calls)
+
+
+def parallel(calls: list[tuple]):
+    with ThreadPoolExecutor(JOBS) as executor:
+        for future in [executor.submit(*call) for call in calls]:
+            future.result()
+
+
+def blobs_upload(blobs: dict[str, str], then: Callable[[], None], bases: dict[str, str] = {}):
+    def send(missing: list[str]):
+        missing = [hash for hash in missing if not (hash in bases and blob_patch(hash, blobs[hash], bases[hash]))]
+        small = {hash: blobs[hash] for hash in missing if os.path.getsize(blobs[hash]) <= TRANSFER_CHUNK}
+        if len(small) > 0 and api_stream("blob-archive", {}, blobs=small) == None:
+            return
+
+        for hash in missing:
+            if not hash in small and not blob_upload(hash, blobs[hash]):
+                return
+
+        then()
+
+    api_queue("blob-missing", {"hashes": list(blobs)}, send)
+
+
+def blob_upload(hash: str, path: str) -> bool:
+    size = os.path.getsize(path)
+    session = api("upload-begin", {"hash": hash, "size": size, "chunk": TRANSFER_CHUNK})
+    if session == None:
+        return False
+
+    with open(path, "rb") as f:
+        for index in range((size + TRANSFER_CHUNK - 1) // TRANSFER_CHUNK):
+            if index in session["chunks"]:
+                continue
+
+            f.seek(index * TRANSFER_CHUNK)
+            chunk = f.read(TRANSFER_CHUNK)
+            data = {"session": session["session"], "index": index, "hash": hashlib.sha256(chunk).hexdigest()}
+            if api_stream("upload-chunk", data, body=io.BytesIO(chunk)) == None:
+                return False
+
+    return api("upload-finish", {"session": session["session"]}) != None
+
+
+def blob_download(hash: str, path: str, base: str | None = None) -> bool:
+    with LOCK:
+        lock = TRANSFERS.setdefault(hash, threading.Lock())
+
+    with lock:
+        os.makedirs(f"{DIR}/transfers", 0o700, exist_ok=True)
+        partial = f"{DIR}/transfers/{hash}"
+        if base == None or not blob_unpatch(hash, base, partial):
+            with open(os.open(partial, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), "ab") as f:
+                if not api_stream("blob-download", {"hash": hash, "offset": f.tell()}, output=f):
+                    return False
+
+            if sha256(partial) != hash:
+                os.remove(partial)
+                return False
+
+        try:
+            os.replace(partial, path)
+        except OSError:
+            tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.mam")
+            try:
+                file_clone(partial, tmp)
+                os.replace(tmp, path)
+            finally:
+                if os.path.isfile(tmp):
+                    os.remove(tmp)
+
+            os.remove(partial)
+
+        return True
+
+
+def delta_block(size: int) -> int:
+    return 1 << max(11, min(16, size.bit_length() // 2))
+
+
+def delta_match(data: bytes | mmap.mmap, signature: dict, block: int) -> Iterator[tuple[int, list[int]]]:
+    table = {}
+    for index, (weak, _) in enumerate(signature["blocks"]):
+        table.setdefault(weak, []).append(index)
+
+    budget = DELTA_ROLL
+    position = 0
+    weak = None
+    while position + block <= len(data):
+        if weak == None:
+            weak = zlib.adler32(data[position : position + block])
+
+        if weak in table:
+            strong = hashlib.md5(data[position : position + block]).hexdigest()
+            indexes = [index for index in table[weak] if signature["blocks"][index][1] == strong]
+            if len(indexes) > 0:
+                yield position, indexes
+                position += block
+                weak = None
+                continue
+
+        if budget > 0 and position + block < len(data):
+            a = ((weak & 0xFFFF) - data[position] + data[position + block]) % 65521
+            b = ((weak >> 16) - block * data[position] - 1 + a) % 65521
+            weak = b << 16 | a
+            position += 1
+            budget -= 1
+        else:
+            position += block
+            weak = None
+
+    total = len(signature["blocks"])
+    if total > 0 and 0 < len(data) - position == signature["size"] - (total - 1) * block:
+        tail = data[position:]
+        if [zlib.adler32(tail), hashlib.md5(tail).hexdigest()] == signature["blocks"][-1]:
+            yield position, [total - 1]
+
+
+def blob_patch(hash: str, path: str, base: str) -> bool:
+    data = file_read(path)
+    if len(data) < DELTA_THRESHOLD:
+        return False
+
+    block = delta_block(len(data))
+    signature = api("blob-signature", {"hash": base, "block": block})
+    if signature == None:
+        return False
+
+    ops = []
+    offset = 0
+    for position, indexes in delta_match(data, signature, block):
+        if position > offset:
+            ops.append(["L", offset, position - offset])
+
+        if len(ops) > 0 and ops[-1][0] == "C" and ops[-1][1] + ops[-1][2] == indexes[0]:
+            ops[-1][2] += 1
+        else:
+            ops.append(["C", indexes[0], 1])
+
+        offset = min(position + block, len(data))
+
+    if offset < len(data):
+        ops.append(["L", offset, len(data) - offset])
+
+    if sum(op[2] for op in ops if op[0] == "L") * 2 > len(data):
+        return False
+
+    def frames(sent: dict[str, int]) -> Iterator[bytes]:
+        for op in ops:
+            chunks = [f"C {op[1]} {op[2]}\n".encode()] if op[0] == "C" else [f"L {op[2]}\n".encode()]
+            if op[0] == "L":
+                chunks += [data[start : min(start + CHUNK_SIZE, op[1] + op[2])] for start in range(op[1], op[1] + op[2], CHUNK_SIZE)]
+
+            for chunk in chunks:
+                sent["bytes"] += len(chunk)
+                sent["wire"] += len(chunk)
+                yield chunk
+
+    return api_stream("blob-patch", {"base": base, "hash": hash, "block": block}, body=frames) != None
+
+
+def blob_unpatch(hash: str, base: str, path: str) -> bool:
+    data = file_read(base)
+    if len(data) < DELTA_THRESHOLD or os.path.isfile(path):
+        return False
+
+    block = delta_block(len(data))
+    signature = api("blob-signature", {"hash": hash, "block": block})
+    if signature == None:
+        return False
+
+    found = {}
+    for position, indexes in delta_match(data, signature, block):
+        for index in indexes:
+            found.setdefault(index, position)
+
+    total = len(signature["blocks"])
+    ranges = []
+    for index in range(total):
+        if index in found:
+            continue
+
+        if len(ranges) > 0 and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+
+    if (total - len(found)) * 2 > total or len(ranges) > DELTA_RANGES:
+        return False
+
+    try:
+        with file_create(f"{path}.blocks", "w+b") as blocks:
+            spans = ",".join(f"{start}-{end}" for start, end in ranges)
+            if len(ranges) > 0 and not api_stream("blob-blocks", {"hash": hash, "block": block, "ranges": spans}, output=blocks):
+                return False
+
+            blocks.seek(0)
+            with file_create(path) as f:
+                for index in range(total):
+                    length = block if index < total - 1 else signature["size"] - index * block
+                    f.write(data[found[index] : found[index] + length] if index in found else blocks.read(length))
+    finally:
+        if os.path.isfile(f"{path}.blocks"):
+            os.remove(f"{path}.blocks")
+
+    if sha256(path) != hash:
+        os.remove(path)
+        return False
+
+    return True
+
+
+def transfers_prune():
+    for path in glob.glob(f"{DIR}/transfers/*"):
+        if os.path.getmtime(path) < time.time() - 86400:
+            os.remove(path)
+
+
+def inotify_init() -> int:
+    fd = LIBC.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    return fd
+
+
+def inotify_watch(fd: int, path: str) -> int | None:
+    wd = LIBC.inotify_add_watch(fd, path.encode(), IN_EVENTS)
+    return wd if wd >= 0 else None
+
+
+def inotify_read(fd: int) -> list[tuple[int, int, str]]:
+    data = os.read(fd, 1 << 16)
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+        name = data[offset + 16 : offset + 16 + length].rstrip(b"\0").decode(errors="surrogateescape")
+        events.append((wd, mask, name))
+        offset += 16 + length
+
+    return events
+
+
 def file_version(obj: str) -> int:
     file = b32d(obj)
     if not os.path.isfile(file):
@@ -136,44 +986,45 @@ def file_version(obj: str) -> int:
 
 
 def file_syncVersion(obj: str) -> tuple[int, int]:
-    data = json_read(f"{DIR}/objects/files/{obj}", {"local": 0, "remote": 0})
-    return data["local"], data["remote"]
+    state = state_read("files", obj)
+    return state["local"], state["remote"]
 
 
 def file_backup(obj: str):
-    file = b32d(obj)
-    if not os.path.isfile(file):
-        return
-
-    stat = os.stat(file)
-    shutil.copy(file, f"{DIR}/backups/files/{obj}")
-    os.chown(f"{DIR}/backups/files/{obj}", stat.st_uid, stat.st_gid)
-    os.chmod(f"{DIR}/backups/files/{obj}", stat.st_mode)
+    backup_file("files", obj)
 
 
 def file_restore(obj: str):
-    file = b32d(obj)
-    if os.path.isfile(file):
-        os.remove(file)
+    backup_file_restore("files", obj)
 
-    if os.path.isfile(f"{DIR}/backups/files/{obj}"):
-        shutil.move(f"{DIR}/backups/files/{obj}", file)
 
-    if os.path.isfile(f"{DIR}/objects/files/{obj}"):
-        os.remove(f"{DIR}/objects/files/{obj}")
-
-
-def file_download(obj: str, version: int):
+def file_download(obj: str, meta: dict):
     file = b32d(obj)
-    dirs = makedirs(os.path.dirname(file))
-    meta = api("file-get-meta", {"id": obj})
+    if not meta["hash"]:
+        return
 
-    with open(file, "wb") as f:
-        f.write(b64d(api("file-get-content", {"id": obj})))
+    dirs = makedirs(os.path.dirname(file))
+    base = file if os.path.isfile(file) else None
+    if not (base != None and sha256(file) == meta["hash"]) and not blob_download(meta["hash"], file, base):
+        return
 
     os.chown(file, meta["owner"], meta["group"])
     os.chmod(file, meta["mode"])
-    json_write(f"{DIR}/objects/files/{obj}", {"local": file_version(obj), "remote": version})
+    stat = os.stat(file)
+    state_write(
+        "files",
+        obj,
+        {
+            "local": file_version(obj),
+            "remote": meta["version"],
+            "hash": meta["hash"],
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "owner": stat.st_uid,
+            "group": stat.st_gid,
+            "mode": stat.st_mode,
+        },
+    )
     handleCreatedDirs(dirs, meta["owner"], meta["group"])
 
 
@@ -181,12 +1032,42 @@ def file_upload(obj: str):
     file = b32d(obj)
     version = file_version(obj)
     stat = os.stat(file)
+    state = state_read("files", obj)
 
-    with open(file, "rb") as f:
-        api("file-set-content", {"id": obj, "content": b64e(f.read()), "version": version})
+    if state.get("size") == stat.st_size and state.get("mtime") == stat.st_mtime_ns:
+        hash = state["hash"]
+    else:
+        hash = sha256(file)
+
+    current = {
+        "hash": hash,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "owner": stat.st_uid,
+        "group": stat.st_gid,
+        "mode": stat.st_mode,
+    }
+
+    if all(state.get(key) == current[key] for key in ["hash", "owner", "group", "mode"]):
+        state_write("files", obj, {**state, **current, "local": version})
+        return
 
-    api("file-set-meta", {"id": obj, "owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode})
-    json_write(f"{DIR}/objects/files/{obj}", {"local": version, "remote": version})
+    def send():
+        api_queue_group(
+            [
+                ("file-set-content", {"id": obj, "hash": hash, "version": version}, None),
+                (
+                    "file-set-meta",
+                    {"id": obj, "owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode},
+                    lambda _: state_write("files", obj, {"local": version, "remote": version, **current}),
+                ),
+            ]
+        )
+
+    if hash == state.get("hash"):
+        send()
+    else:
+        blobs_upload({hash: file}, send, {hash: state["hash"]} if state.get("hash") else {})
 
 
 def directory_version(obj: str) -> int:
@@ -196,43 +1077,132 @@ def directory_version(obj: str) -> int:
 
     stat = os.stat(dir)
     version = int(max(stat.st_mtime, stat.st_ctime))
-    for root, dirs, files in os.walk(dir):
-        for file in files:
-            stat = os.stat(os.path.join(root, file))
-            version = int(max(version, stat.st_mtime, stat.st_ctime))
-
-        for dir in dirs:
-            stat = os.stat(os.path.join(root, dir))
-            version = int(max(version, stat.st_mtime, stat.st_ctime))
+    entries, _ = directory_scan(obj)
+    for entry in entries.values():
+        version = max(version, entry[2] // 1_000_000_000, entry[3] // 1_000_000_000)
 
     return version
 
 
+def directory_scan(obj: str) -> tuple[dict, set[str]]:
+    if obj in SCANS:
+        return SCANS[obj][:2]
+
+    directory = b32d(obj)
+    rows = query("SELECT data FROM snapshots WHERE id = ?", (obj,))
+    snapshot = json.loads(rows[0][0]) if len(rows) > 0 else {"listings": {}, "entries": {}}
+
+    listings = {}
+    entries = {}
+    pending = [""]
+    while len(pending) > 0:
+        root = pending.pop()
+        try:
+            stat = os.stat(os.path.join(directory, root))
+        except FileNotFoundError:
+            continue
+
+        listing = snapshot["listings"].get(root)
+        if listing == None or listing[:2] != [stat.st_ino, stat.st_mtime_ns]:
+            with os.scandir(os.path.join(directory, root)) as it:
+                listing = [stat.st_ino, stat.st_mtime_ns, {entry.name: entry.is_symlink() for entry in it}]
+
+        listings[root] = listing
+        for name, link in listing[2].items():
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(os.path.join(directory, path))
+            except FileNotFoundError:
+                continue
+
+            entries[path] = [stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_mode, stat.st_uid, stat.st_gid]
+            if S_ISDIR(stat.st_mode) and not link:
+                pending.append(path)
+
+    changed = {path for path in entries if snapshot["entries"].get(path) != entries[path]}
+    changed.update(path for path in snapshot["entries"] if not path in entries)
+    SCANS[obj] = (entries, changed, {"listings": listings, "entries": entries})
+
+    return entries, changed
+
+
+def directory_snapshot(obj: str, scan: tuple[dict, set[str], dict]):
+    query("INSERT OR REPLACE INTO snapshots (id, data) VALUES (?, ?)", (obj, json.dumps(scan[2])))
+
+
+def directory_content(directory: str, cache: dict) -> tuple[dict, dict]:
+    content = {"dirs": {}, "files": {}}
+    hashes = {}
+    entries, changed = directory_scan(b32e(directory))
+    for path, entry in entries.items():
+        _, size, mtime, _, mode, owner, group = entry
+        key = b32e(path)
+        if S_ISDIR(mode):
+            content["dirs"][key] = {"owner": owner, "group": group, "mode": mode}
+            continue
+
+        if key in cache and (not path in changed or cache[key][:2] == [size, mtime]):
+            hash = cache[key][2]
+        else:
+            hash = sha256(os.path.join(directory, path))
+
+        hashes[key] = [size, mtime, hash]
+        content["files"][key] = {
+            "owner": owner,
+            "group": group,
+            "mode": mode,
+            "size": size,
+            "hash": hash,
+        }
+
+    return content, hashes
+
+
+def directory_swap(stage: str, directory: str):
+    if not os.path.isdir(directory):
+        os.rename(stage, directory)
+        return
+
+    if hasattr(LIBC, "renameat2"):
+        if LIBC.renameat2(AT_FDCWD, stage.encode(), AT_FDCWD, directory.encode(), RENAME_EXCHANGE) == 0:
+            return
+
+        error = ctypes.get_errno()
+        if not error in [errno.ENOSYS, errno.EINVAL]:
+            raise OSError(error, os.strerror(error), directory)
+
+    os.rename(directory, f"{stage}.old")
+    try:
+        os.rename(stage, directory)
+    except OSError:
+        os.rename(f"{stage}.old", directory)
+        raise
+
+    os.rename(f"{stage}.old", stage)
+
+
 def directory_syncVersion(obj: str) -> tuple[int, int]:
-    data = json_read(f"{DIR}/objects/directories/{obj}", {"local": 0, "remote": 0})
-    return data["local"], data["remote"]
+    state = state_read("directories", obj)
+    return state["local"], state["remote"]
 
 
 def directory_backup(obj: str):
     directory = b32d(obj)
-    if not os.path.isdir(directory):
+    if not os.path.isdir(directory) or backup_exists("directories", obj):
         return
 
     stat = os.stat(directory)
-    shutil.copytree(directory, f"{DIR}/backups/directories/{obj}")
-    os.chown(f"{DIR}/backups/directories/{obj}", stat.st_uid, stat.st_gid)
-    os.chmod(f"{DIR}/backups/directories/{obj}", stat.st_mode)
+    backup = {"owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode, "dirs": {}, "files": {}, "links": {}}
+    entries, _ = directory_scan(obj)
+    for path, entry in entries.items():
+        if os.path.islink(os.path.join(directory, path)):
+            backup["links"][path] = os.readlink(os.path.join(directory, path))
+        elif S_ISDIR(entry[4]):
+            backup["dirs"][path] = {"owner": entry[5], "group": entry[6], "mode": entry[4]}
+        elif S_ISREG(entry[4]):
+            backup["files"][path] = backup_blob(os.path.join(directory, path))
 
-    for root, dirs, files in os.walk(f"{DIR}/backups/directories/{obj}"):
-        for file in files:
-            stat = os.stat(os.path.join(root.replace(f"{DIR}/backups/directories/{obj}", directory), file))
-            os.chown(os.path.join(root, file), stat.st_uid, stat.st_gid)
-            os.chmod(os.path.join(root, file), stat.st_mode)
-
-        for dir in dirs:
-            stat = os.stat(os.path.join(root.replace(f"{DIR}/backups/directories/{obj}", directory), dir))
-            os.chown(os.path.join(root, dir), stat.st_uid, stat.st_gid)
-            os.chmod(os.path.join(root, dir), stat.st_mode)
+    backup_add("directories", obj, backup)
 
 
 def directory_restore(obj: str):
@@ -240,99 +1210,325 @@ def directory_restore(obj: str):
     if os.path.isdir(directory):
         shutil.rmtree(directory)
 
-    if os.path.isdir(f"{DIR}/backups/directories/{obj}"):
+    backup = backup_read("directories", obj)
+    if backup == {}:
         shutil.move(f"{DIR}/backups/directories/{obj}", directory)
+    elif backup != None:
+        os.makedirs(directory, exist_ok=True)
+        for path in sorted(backup["dirs"]):
+            os.makedirs(os.path.join(directory, path), exist_ok=True)
 
-    if os.path.isfile(f"{DIR}/objects/directories/{obj}"):
-        os.remove(f"{DIR}/objects/directories/{obj}")
+        for path, target in backup.get("links", {}).items():
+            os.symlink(target, os.path.join(directory, path))
 
+        hashes = backup_hashes("directories", obj)
+        last = {entry["hash"]: path for path, entry in backup["files"].items()}
+        for path, entry in backup["files"].items():
+            backup_restore(entry, os.path.join(directory, path), entry["hash"] in hashes or last[entry["hash"]] != path)
 
-def directory_download(obj: str, version: int):
-    directory = b32d(obj)
-    dirs = makedirs(os.path.dirname(directory))
-    meta = api("directory-get-meta", {"id": obj})
+        for path, meta in [*sorted(backup["dirs"].items(), reverse=True), ("", backup)]:
+            os.chown(os.path.join(directory, path), meta["owner"], meta["group"])
+            os.chmod(os.path.join(directory, path), meta["mode"])
 
-    if os.path.isdir(directory):
-        shutil.rmtree(directory)
+    backup_delete("directories", obj)
+    state_delete("directories", obj)
+    query("DELETE FROM snapshots WHERE id = ?", (obj,))
+    SCANS.pop(obj, None)
 
-    os.mkdir(directory)
-    os.chown(directory, meta["owner"], meta["group"])
-    os.chmod(directory, meta["mode"])
 
-    content = api("directory-get-content", {"id": obj})
-    for dir in sorted(content["dirs"], key=lambda dir: dir.count("/")):
-        path = os.path.join(directory, b32d(dir))
-        meta = content["dirs"][dir]
-        os.mkdir(path)
-        os.chown(path, meta["owner"], meta["group"])
-        os.chmod(path, meta["mode"])
+def directory_download(obj: str, meta: dict):
+    directory = b32d(obj)
 
-    for file in content["files"]:
-        path = os.path.join(directory, b32d(file))
-        meta = content["files"][file]
+    def receive(content: dict):
+        content = {"dirs": content["dirs"] or {}, "files": content["files"] or {}}
+        state = state_read("directories", obj)
 
-        with open(path, "wb") as f:
-            f.write(b64d(meta["content"]))
+        dirs = makedirs(os.path.dirname(directory))
+        if os.path.lexists(directory) and not os.path.isdir(directory):
+            os.remove(directory)
 
-        os.chown(path, meta["owner"], meta["group"])
-        os.chmod(path, meta["mode"])
+        stage = os.path.join(os.path.dirname(directory), f".{os.path.basename(directory)}.mam")
+        if not os.path.lexists(directory) and os.path.isdir(f"{stage}.old"):
+            os.rename(f"{stage}.old", directory)
 
-    json_write(f"{DIR}/objects/directories/{obj}", {"local": directory_version(obj), "remote": version})
-    handleCreatedDirs(dirs, meta["owner"], meta["group"])
+        local, hashes = directory_content(directory, state.get("hashes", {}))
+        if os.path.isdir(stage):
+            shutil.rmtree(stage)
+
+        os.mkdir(stage)
+        try:
+            for dir in sorted(content["dirs"], key=lambda dir: b32d(dir).count("/")):
+                os.mkdir(os.path.join(stage, b32d(dir)))
+
+            fetched = {}
+            for file in content["files"]:
+                live = os.path.join(directory, b32d(file))
+                path = os.path.join(stage, b32d(file))
+                entry = content["files"][file]
+                current = local["files"].get(file)
+                same = current != None and current["hash"] == entry["hash"]
+
+                if same and all(current[key] == entry[key] for key in ["owner", "group", "mode"]):
+                    try:
+                        os.link(live, path)
+                        continue
+                    except OSError:
+                        pass
+
+                if same:
+                    file_clone(live, path)
+                elif entry["hash"] in fetched:
+                    file_clone(fetched[entry["hash"]], path)
+                elif blob_download(entry["hash"], path, live if current != None else None):
+                    fetched[entry["hash"]] = path
+                else:
+                    return
+
+                os.chown(path, entry["owner"], entry["group"])
+                os.chmod(path, entry["mode"])
+                stat = os.stat(path)
+                hashes[file] = [stat.st_size, stat.st_mtime_ns, entry["hash"]]
+
+            for dir in sorted(content["dirs"], key=lambda dir: b32d(dir).count("/"), reverse=True):
+                path = os.path.join(stage, b32d(dir))
+                os.chown(path, content["dirs"][dir]["owner"], content["dirs"][dir]["group"])
+                os.chmod(path, content["dirs"][dir]["mode"])
+
+            os.chown(stage, meta["owner"], meta["group"])
+            os.chmod(stage, meta["mode"])
+            directory_swap(stage, directory)
+        finally:
+            if os.path.isdir(stage):
+                shutil.rmtree(stage)
+
+        hashes = {file: hashes[file] for file in content["files"]}
+        stat = os.stat(directory)
+        SCANS.pop(obj, None)
+        version = directory_version(obj)
+        directory_snapshot(obj, SCANS[obj])
+        state_write(
+            "directories",
+            obj,
+            {
+                "local": version,
+                "remote": meta["version"],
+                "content": content,
+                "hashes": hashes,
+                "owner": stat.st_uid,
+                "group": stat.st_gid,
+                "mode": stat.st_mode,
+            },
+        )
+        handleCreatedDirs(dirs, meta["owner"], meta["group"])
+
+    api_queue("directory-get-entries", {"id": obj}, receive)
 
 
 def directory_upload(obj: str):
     directory = b32d(obj)
     version = directory_version(obj)
+    state = state_read("directories", obj)
+    content, hashes = directory_content(directory, state.get("hashes", {}))
+    scan = SCANS[obj]
+    synced = state.get("content")
+
+    blobs = {}
+    patch = {"set": {"dirs": {}, "files": {}}, "delete": {"dirs": [], "files": []}}
+    for type in ["dirs", "files"]:
+        if synced == None:
+            patch["set"][type] = content[type]
+            continue
 
-    content = {"dirs": {}, "files": {}}
-    for root, dirs, files in os.walk(directory):
-        for dir in dirs:
-            path = os.path.join(root, dir)
-            stat = os.stat(path)
-            content["dirs"][b32e(os.path.relpath(path, directory))] = {"owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode}
-
-        for file in files:
-            path = os.path.join(root, file)
-            stat = os.stat(path)
-            with open(path, "rb") as f:
-                content["files"][b32e(os.path.relpath(path, directory))] = {
-                    "owner": stat.st_uid,
-                    "group": stat.st_gid,
-                    "mode": stat.st_mode,
-                    "content": b64e(f.read()),
-                }
+        for path in map(b32e, scan[1]):
+            if path in content[type] and synced[type].get(path) != content[type][path]:
+                patch["set"][type][path] = content[type][path]
+            elif not path in content[type] and path in synced[type]:
+                patch["delete"][type].append(path)
+
+    bases = {}
+    for file in patch["set"]["files"]:
+        blobs[patch["set"]["files"][file]["hash"]] = os.path.join(directory, b32d(file))
+        if synced != None and file in synced["files"]:
+            bases[patch["set"]["files"][file]["hash"]] = synced["files"][file]["hash"]
 
     stat = os.stat(directory)
-    api("directory-set-content", {"id": obj, "content": content, "version": version})
-    api("directory-set-meta", {"id": obj, "owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode})
-    json_write(f"{DIR}/objects/directories/{obj}", {"local": version, "remote": version})
+    meta = {"owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode}
+
+    changed = any(len(patch[action][type]) > 0 for action in ["set", "delete"] for type in ["dirs", "files"])
+    if synced != None and not changed and all(state.get(key) == meta[key] for key in meta):
+        directory_snapshot(obj, scan)
+        state_write("directories", obj, {**state, "local": version, "hashes": hashes})
+        return
+
+    def synchronized(_):
+        directory_snapshot(obj, scan)
+        state_write("directories", obj, {"local": version, "remote": version, "content": content, "hashes": hashes, **meta})
+
+    def send():
+        if synced == None:
+            update = ("directory-set-content", {"id": obj, "content": content, "version": version}, None)
+        else:
+            update = ("directory-patch-content", {"id": obj, **patch, "version": version}, None)
 
+        api_queue_group(
+            [
+                update,
+                ("directory-set-meta", {"id": obj, **meta}, synchronized),
+            ]
+        )
 
-def package_backup(obj: str):
-    if os.system(f"paru -Q {b32d(obj)}") == 0:
-        open(f"{DIR}/backups/packages/{obj}", "w").close()
+    blobs_upload(blobs, send, bases)
+
+
+def packages_installed() -> dict[str, str]:
+    global INSTALLED, PROVIDED
+    if INSTALLED != None:
+        return INSTALLED
+
+    packages = {}
+    provides = {}
+    for entry in os.scandir("/var/lib/pacman/local"):
+        fields = {}
+        for line in lines_read(f"{entry.path}/desc"):
+            if line.startswith("%") and line.endswith("%"):
+                field = fields.setdefault(line, [])
+            elif line:
+                field.append(line)
+
+        if "%NAME%" in fields and "%VERSION%" in fields:
+            packages[fields["%NAME%"][0]] = fields["%VERSION%"][0]
+            for provide in fields.get("%PROVIDES%", []):
+                name, _, version = provide.partition("=")
+                provides[re.split("[<>]", name)[0]] = version or fields["%VERSION%"][0]
+
+    INSTALLED = packages
+    PROVIDED = {**provides, **packages}
+    return INSTALLED
+
+
+def packages_provided() -> dict[str, str]:
+    packages_installed()
+    return PROVIDED
+
+
+def packages_invalidate():
+    global INSTALLED, PROVIDED
+    INSTALLED = None
+    PROVIDED = None
+
+
+def package_backup(obj: str, installed: dict[str, str]):
+    if b32d(obj) in installed:
+        backup_add("packages", obj)
 
 
 def package_restore(obj: str):
-    if os.path.isfile(f"{DIR}/backups/packages/{obj}"):
-        os.remove(f"{DIR}/backups/packages/{obj}")
+    if backup_exists("packages", obj):
+        backup_delete("packages", obj)
     else:
         os.system(f"paru --noconfirm -Rs {b32d(obj)}")
+        packages_invalidate()
 
-    if os.path.isfile(f"{DIR}/objects/packages/{obj}"):
-        os.remove(f"{DIR}/objects/packages/{obj}")
+    state_delete("packages", obj)
 
 
-def package_install(obj: str):
-    if os.system(f"paru -Q {b32d(obj)}") != 0:
-        if os.system(f"paru -Syia {b32d(obj)}") != 0:
-            os.system(f"paru --noconfirm -Sy {b32d(obj)}")
-        else:
+def packages_install(packages: dict[str, dict], installed: dict[str, str], refresh: bool = False):
+    missing = [obj for obj in packages if not b32d(obj) in installed]
+    if len(missing) > 0:
+        os.system("pacman -Sy")
+        sources = {obj: None if refresh else packages[obj].get("source") for obj in missing}
+        if None in sources.values():
+            repo = set(os.popen("pacman -Slq").read().split()) | set(os.popen("pacman -Sg").read().split())
+            for obj in sources:
+                if sources[obj] == None:
+                    sources[obj] = "repo" if b32d(obj) in repo else "aur"
+
+        native = [b32d(obj) for obj in missing if sources[obj] == "repo"]
+        if len(native) > 0:
+            os.system(f"pacman --noconfirm --needed -S {' '.join(native)}")
+
+        packages_invalidate()
+        foreign = packages_fetch([b32d(obj) for obj in missing if sources[obj] == "aur"])
+        if len(foreign) > 0:
             os.system("mkdir -p /tmp/mam && chown mam:mam /tmp/mam")
-            os.system(f"sudo -u mam HOME=/tmp/mam paru --noconfirm -Sy {b32d(obj)}")
+            os.system(f"sudo -u mam HOME=/tmp/mam paru --noconfirm --needed --aur -S {' '.join(foreign)}")
+            packages_invalidate()
+            packages_share(foreign)
+
+        installed = packages_installed()
+        for obj in missing:
+            source = sources[obj] if b32d(obj) in installed else None
+            if source != packages[obj].get("source"):
+                api_queue("package-set-source", {"id": obj, "source": source})
+
+        api_flush()
+
+    for obj in packages:
+        state_write("packages", obj, {})
+
+
+def aur_versions(names: list[str]) -> dict[str, str]:
+    args = urllib.parse.urlencode([("arg[]", name) for name in names])
+    try:
+        res = json.loads(urllib.request.urlopen(f"https://aur.archlinux.org/rpc/v5/info?{args}", timeout=30).read())
+    except:
+        return {}
+
+    return {package["Name"]: package["Version"] for package in res.get("results", []) if package["Name"] in names}
+
+
+def packages_fetch(names: list[str]) -> list[str]:
+    versions = aur_versions(names) if len(names) > 0 else {}
+    if len(versions) == 0:
+        return names
 
-    open(f"{DIR}/objects/packages/{obj}", "w").close()
+    files = []
+    os.makedirs(f"{DIR}/packages", exist_ok=True)
+    for name, build in (api("build-list", {"versions": versions, "arch": os.uname().machine}) or {}).items():
+        if build["version"] != versions.get(name):
+            continue
+
+        path = f"{DIR}/packages/{os.path.basename(build['file'])}"
+        if blob_download(build["hash"], path):
+            files.append(path)
+
+    if len(files) > 0:
+        subprocess.run(["pacman", "--noconfirm", "--needed", "-U", *files])
+        packages_invalidate()
+
+    shutil.rmtree(f"{DIR}/packages")
+    installed = packages_installed()
+    return [name for name in names if not name in installed]
+
+
+def packages_share(names: list[str]):
+    installed = packages_installed()
+    blobs = {}
+    builds = []
+    for name in names:
+        if not name in installed:
+            continue
+
+        prefix = f"{name}-{installed[name]}-"
+        for path in glob.glob(f"/tmp/mam/.cache/paru/clone/*/{glob.escape(prefix)}*.pkg.tar.*"):
+            file = os.path.basename(path)
+            if file.endswith(".sig"):
+                continue
+
+            hash = sha256(path)
+            arch = file[len(prefix) :].split(".pkg.tar")[0]
+            blobs[hash] = path
+            builds.append({"name": name, "version": installed[name], "arch": arch, "file": file, "hash": hash})
+
+    if len(builds) == 0:
+        return
+
+    def send():
+        for build in builds:
+            api_queue("build-add", build)
+
+    blobs_upload(blobs, send)
+    api_flush()
 
 
 def partial_version(obj: str) -> int:
@@ -345,86 +1541,115 @@ def partial_version(obj: str) -> int:
 
 
 def partial_syncVersion(obj: str) -> tuple[int, int]:
-    data = json_read(f"{DIR}/objects/partials/{obj}", {"local": 0, "remote": 0})
-    return data["local"], data["remote"]
+    state = state_read("partials", obj)
+    return state["local"], state["remote"]
 
 
 def partial_backup(obj: str):
-    partial = b32d(obj)
-    if not os.path.isfile(partial):
-        return
-
-    stat = os.stat(partial)
-    shutil.copy(partial, f"{DIR}/backups/partials/{obj}")
-    os.chown(f"{DIR}/backups/partials/{obj}", stat.st_uid, stat.st_gid)
-    os.chmod(f"{DIR}/backups/partials/{obj}", stat.st_mode)
+    backup_file("partials", obj)
 
 
 def partial_restore(obj: str):
-    partial = b32d(obj)
-    if os.path.isfile(partial):
-        os.remove(partial)
+    backup_file_restore("partials", obj)
 
-    if os.path.isfile(f"{DIR}/backups/partials/{obj}"):
-        shutil.move(f"{DIR}/backups/partials/{obj}", partial)
 
-    if os.path.isfile(f"{DIR}/objects/partials/{obj}"):
-        os.remove(f"{DIR}/objects/partials/{obj}")
+def partial_apply(lines: list[str], content: list[dict], replace: bool):
+    patterns = [re.compile(cnt["pattern"]) for cnt in content]
+    sections = [re.compile(cnt["section"]) if cnt["section"] != None else None for cnt in content]
+    active = [section == None for section in sections]
+
+    sources = [cnt[key] for cnt in content for key in ["pattern", "section"] if cnt[key] != None]
+    prefilter = None
+    if not any(re.search(r"\\[1-9]|\(\?P=|\(\?\(", source) for source in sources):
+        try:
+            prefilter = re.compile("|".join(f"(?:{source})" for source in sources))
+        except re.error:
+            pass
+
+    for i in range(len(lines)):
+        if prefilter != None and not prefilter.match(lines[i]):
+            continue
 
+        for j in range(len(content)):
+            if active[j] and patterns[j].match(lines[i]):
+                if replace:
+                    lines[i] = content[j]["value"]
+                else:
+                    content[j]["value"] = lines[i]
 
-def partial_download(obj: str, version: int):
+                active[j] = sections[j] == None
+            elif not active[j] and sections[j].match(lines[i]):
+                active[j] = True
+
+
+def projection(content: object, stat: os.stat_result) -> str:
+    return hashlib.sha256(json.dumps([content, stat.st_uid, stat.st_gid, stat.st_mode]).encode()).hexdigest()
+
+
+def partial_download(obj: str, meta: dict):
     partial = b32d(obj)
     dirs = makedirs(os.path.dirname(partial))
-    meta = api("partial-get-meta", {"id": obj})
-
-    lines = lines_read(partial)
-    content = api("partial-get-content", {"id": obj})
-    for cnt in content:
-        cnt["active"] = cnt["section"] == None
 
-    for i in range(len(lines)):
-        for cnt in content:
-            if cnt["active"] and re.match(cnt["pattern"], lines[i]):
-                lines[i] = cnt["value"]
-                cnt["active"] = cnt["section"] == None
-            elif not cnt["active"] and re.match(cnt["section"], lines[i]):
-                cnt["active"] = True
-
-    lines_write(partial, lines)
+    data = file_read(partial)
+    spans = file_lines(data)
+    lines = [line for _, _, line in spans]
+    partial_apply(lines, meta["content"], True)
+    file_splice(
+        partial,
+        data,
+        [(start, stop, line.encode(errors="surrogateescape")) for (start, stop, old), line in zip(spans, lines) if line != old],
+    )
     os.chown(partial, meta["owner"], meta["group"])
     os.chmod(partial, meta["mode"])
-    json_write(f"{DIR}/objects/partials/{obj}", {"local": partial_version(obj), "remote": version})
+    state_write(
+        "partials",
+        obj,
+        {
+            "local": partial_version(obj),
+            "remote": meta["version"],
+            "content": meta["content"],
+            "projection": projection([cnt["value"] for cnt in meta["content"]], os.stat(partial)),
+        },
+    )
     handleCreatedDirs(dirs, meta["owner"], meta["group"])
 
 
-def partial_upload(obj: str):
+def partial_upload(obj: str, force: bool = False):
     partial = b32d(obj)
     version = partial_version(obj)
     stat = os.stat(partial)
-
-    lines = lines_read(partial)
-    content = api("partial-get-content", {"id": obj})
-    for cnt in content:
-        cnt["active"] = cnt["section"] == None
-
-    for line in lines:
-        for cnt in content:
-            if cnt["active"] and re.match(cnt["pattern"], line):
-                cnt["value"] = line
-                cnt["active"] = cnt["section"] == None
-            elif not cnt["active"] and re.match(cnt["section"], line):
-                cnt["active"] = True
-
-    for cnt in content:
-        del cnt["active"]
-
-    api("partial-set-content", {"id": obj, "content": content, "version": version})
-    api("partial-set-meta", {"id": obj, "owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode})
-    json_write(f"{DIR}/objects/partials/{obj}", {"local": version, "remote": version})
-
-
-def partial_printDetails(obj: str):
-    content = api("partial-get-content", {"id": obj})
+    state = state_read("partials", obj)
+
+    if "content" in state and not force:
+        content = [dict(cnt) for cnt in state["content"]]
+        partial_apply([line for _, _, line in file_lines(file_read(partial))], content, False)
+        if projection([cnt["value"] for cnt in content], stat) == state.get("projection"):
+            state_write("partials", obj, {**state, "local": version})
+            return
+
+    def send(content: list[dict]):
+        partial_apply([line for _, _, line in file_lines(file_read(partial))], content, False)
+        hash = projection([cnt["value"] for cnt in content], stat)
+
+        api_queue_group(
+            [
+                ("partial-set-content", {"id": obj, "content": content, "version": version}, None),
+                (
+                    "partial-set-meta",
+                    {"id": obj, "owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode},
+                    lambda _: state_write(
+                        "partials",
+                        obj,
+                        {"local": version, "remote": version, "content": content, "projection": hash},
+                    ),
+                ),
+            ]
+        )
+
+    api_queue("partial-get-content", {"id": obj}, send)
+
+
+def partial_printDetails(content: list[dict]):
     for cnt in content:
         if cnt["section"] == None:
             print(f"    /{cnt['pattern']}/: {cnt['value']}")
@@ -442,78 +1667,205 @@ def additional_version(obj: str) -> int:
 
 
 def additional_syncVersion(obj: str) -> tuple[int, int]:
-    data = json_read(f"{DIR}/objects/additionals/{obj}", {"local": 0, "remote": 0})
-    return data["local"], data["remote"]
+    state = state_read("additionals", obj)
+    return state["local"], state["remote"]
 
 
 def additional_backup(obj: str):
-    additional = b32d(obj)
-    if not os.path.isfile(additional):
-        return
-
-    stat = os.stat(additional)
-    shutil.copy(additional, f"{DIR}/backups/additionals/{obj}")
-    os.chown(f"{DIR}/backups/additionals/{obj}", stat.st_uid, stat.st_gid)
-    os.chmod(f"{DIR}/backups/additionals/{obj}", stat.st_mode)
+    backup_file("additionals", obj)
 
 
 def additional_restore(obj: str):
-    additional = b32d(obj)
-    if os.path.isfile(additional):
-        os.remove(additional)
+    backup_file_restore("additionals", obj)
 
-    if os.path.isfile(f"{DIR}/backups/additionals/{obj}"):
-        shutil.move(f"{DIR}/backups/additionals/{obj}", additional)
 
-    if os.path.isfile(f"{DIR}/objects/additionals/{obj}"):
-        os.remove(f"{DIR}/objects/additionals/{obj}")
+def additional_block(data: bytes | mmap.mmap, prefix: str) -> tuple[int, int] | None:
+    begin = line_find(data, f"{prefix} BEGIN MAM ADDITIONAL")
+    if begin == None:
+        return None
 
+    end = line_find(data, f"{prefix} END MAM ADDITIONAL", begin[1])
+    return begin[1], end[0] if end != None else len(data)
 
-def additional_download(obj: str, version: int):
-    additional = b32d(obj)
-    dirs = makedirs(os.path.dirname(additional))
-    meta = api("additional-get-meta", {"id": obj})
-
-    lines = lines_read(additional)
-    prefix = api("additional-get-prefix", {"id": obj})
-    content = api("additional-get-content", {"id": obj})
-    if f"{prefix} BEGIN MAM ADDITIONAL" in lines:
-        idx = lines.index(f"{prefix} BEGIN MAM ADDITIONAL") + 1
-        while lines[idx] != f"{prefix} END MAM ADDITIONAL":
-            lines.pop(idx)
-
-        for line in content:
-            lines.insert(idx, line)
-            idx += 1
-    else:
-        lines.append(f"{prefix} BEGIN MAM ADDITIONAL")
-        lines += content
-        lines.append(f"{prefix} END MAM ADDITIONAL")
-
-    lines_write(additional, lines)
-    os.chown(additional, meta["owner"], meta["group"])
-    os.chmod(additional, meta["mode"])
-    json_write(f"{DIR}/objects/additionals/{obj}", {"local": additional_version(obj), "remote": version})
-    handleCreatedDirs(dirs, meta["owner"], meta["group"])
+
+def additional_edit(data: bytes | mmap.mmap, prefix: str, content: list[str]) -> tuple[int, int, bytes]:
+    lines = "".join(f"{line}\n" for line in content)
+    block = additional_block(data, prefix)
+    if block == None:
+        separator = "\n" if len(data) > 0 and data[-1] != 10 else ""
+        lines = f"{separator}{prefix} BEGIN MAM ADDITIONAL\n{lines}{prefix} END MAM ADDITIONAL\n"
+        return len(data), len(data), lines.encode(errors="surrogateescape")
+
+    if line_find(data, f"{prefix} END MAM ADDITIONAL", block[0]) == None:
+        lines += f"{prefix} END MAM ADDITIONAL\n"
+        if data[block[0] - 1] != 10:
+            lines = f"\n{lines}"
+
+    return block[0], block[1], lines.encode(errors="surrogateescape")
 
 
-def additional_upload(obj: str):
+def additional_download(obj: str, meta: dict):
+    def write(content: list[str]):
+        additional = b32d(obj)
+        dirs = makedirs(os.path.dirname(additional))
+
+        data = file_read(additional)
+        file_splice(additional, data, [additional_edit(data, meta["prefix"], content)])
+        os.chown(additional, meta["owner"], meta["group"])
+        os.chmod(additional, meta["mode"])
+        state_write(
+            "additionals",
+            obj,
+            {
+                "local": additional_version(obj),
+                "remote": meta["version"],
+                "prefix": meta["prefix"],
+                "projection": projection(content, os.stat(additional)),
+            },
+        )
+        handleCreatedDirs(dirs, meta["owner"], meta["group"])
+
+    api_queue("additional-get-content", {"id": obj}, write)
+
+
+def additional_content(additional: str, prefix: str) -> list[str]:
+    data = file_read(additional)
+    block = additional_block(data, prefix)
+    return [line for _, _, line in file_lines(data[block[0] : block[1]])] if block != None else []
+
+
+def additional_upload(obj: str, force: bool = False):
     additional = b32d(obj)
     version = additional_version(obj)
     stat = os.stat(additional)
+    state = state_read("additionals", obj)
+
+    if "prefix" in state and not force and projection(additional_content(additional, state["prefix"]), stat) == state.get("projection"):
+        state_write("additionals", obj, {**state, "local": version})
+        return
+
+    def send(prefix: str):
+        content = additional_content(additional, prefix)
+        state = {"local": version, "remote": version, "prefix": prefix, "projection": projection(content, stat)}
+
+        api_queue_group(
+            [
+                ("additional-set-content", {"id": obj, "content": content, "version": version}, None),
+                (
+                    "additional-set-meta",
+                    {"id": obj, "owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode},
+                    lambda _: state_write("additionals", obj, state),
+                ),
+            ]
+        )
+
+    api_queue("additional-get-prefix", {"id": obj}, send)
+
+
+def object_sync(type: str, obj: str, meta: dict, new: bool = False):
+    match type:
+        case "files":
+            backup, version, syncVersion, download, upload = (
+                file_backup,
+                file_version,
+                file_syncVersion,
+                file_download,
+                file_upload,
+            )
+        case "directories":
+            backup, version, syncVersion, download, upload = (
+                directory_backup,
+                directory_version,
+                directory_syncVersion,
+                directory_download,
+                directory_upload,
+            )
+        case "partials":
+            backup, version, syncVersion, download, upload = (
+                partial_backup,
+                partial_version,
+                partial_syncVersion,
+                partial_download,
+                partial_upload,
+            )
+        case _:
+            backup, version, syncVersion, download, upload = (
+                additional_backup,
+                additional_version,
+                additional_syncVersion,
+                additional_download,
+                additional_upload,
+            )
+
+    if new:
+        backup(obj)
+        download(obj, meta)
+        return
 
-    lines = lines_read(additional)
-    prefix = api("additional-get-prefix", {"id": obj})
-    content = []
-    if f"{prefix} BEGIN MAM ADDITIONAL" in lines:
-        idx = lines.index(f"{prefix} BEGIN MAM ADDITIONAL") + 1
-        while lines[idx] != f"{prefix} END MAM ADDITIONAL":
-            content.append(lines[idx])
-            idx += 1
+    local_version = version(obj)
+    local_sync_version, remote_sync_version = syncVersion(obj)
+
+    if meta["version"] > remote_sync_version or local_version == 0:
+        download(obj, meta)
+    elif local_version > local_sync_version:
+        upload(obj)
+
+
+def watch_add(fd: int, watches: dict[int, list[tuple[str, str, str | None, str]]], path: str, target: tuple[str, str, str | None]):
+    wd = inotify_watch(fd, path)
+    if wd != None and not (*target, path) in watches.setdefault(wd, []):
+        watches[wd].append((*target, path))
+
+
+def watch_objects(fd: int) -> dict[int, list[tuple[str, str, str | None, str]]]:
+    watches = {}
+    for type in ["files", "partials", "additionals"]:
+        for obj in state_list(type):
+            path = b32d(obj)
+            watch_add(fd, watches, os.path.dirname(path), (type, obj, os.path.basename(path)))
+
+    for obj in state_list("directories"):
+        directory = b32d(obj)
+        watch_add(fd, watches, os.path.dirname(directory), ("directories", obj, os.path.basename(directory)))
+        for root, _, _ in os.walk(directory):
+            watch_add(fd, watches, root, ("directories", obj, None))
+
+    return watches
+
+
+def watch_remote(revision: int, changes: queue.SimpleQueue, notify: int):
+    while True:
+        result = api("changes-wait", {"revision": revision, "timeout": WATCH_POLL})
+        if result == None:
+            time.sleep(WATCH_POLL)
+            continue
 
-    api("additional-set-content", {"id": obj, "content": content, "version": version})
-    api("additional-set-meta", {"id": obj, "owner": stat.st_uid, "group": stat.st_gid, "mode": stat.st_mode})
-    json_write(f"{DIR}/objects/additionals/{obj}", {"local": version, "remote": version})
+        if len(result["changes"]) > 0:
+            changes.put([(type, obj) for type, obj in result["changes"]])
+            os.write(notify, b"\0")
+
+        revision = result["revision"]
+
+
+def watch_sync(changed: set[tuple[str, str]]) -> bool:
+    manifest = requireAuth("sync-manifest")
+    SCANS.clear()
+    complete = all(type != "packages" and obj in manifest[type] for type, obj in changed)
+    parallel(
+        [
+            (object_sync, type, obj, manifest[type][obj], not obj in state_list(type))
+            for type, obj in changed
+            if type != "packages" and obj in manifest[type]
+        ]
+    )
+    api_flush()
+    DB.commit()
+
+    print(f"Synced {len(changed)} changed object(s) with {STATS['requests']} requests.")
+    if STATS["failed"] > 0:
+        print(f"{STATS['failed']} request(s) failed, affected objects will be retried on the next sync.")
+
+    return complete and STATS["failed"] == 0
 
 
 def action_install():
@@ -525,24 +1877,25 @@ def action_install():
         f.write("mam ALL=(root) NOPASSWD: /usr/bin/pacman\n")
 
     print("Installing dependencies...")
-    if os.system("pacman -Q base-devel") != 0:
+    if not "base-devel" in packages_provided():
         os.system("pacman --noconfirm -Sy base-devel")
 
-    if os.system("pacman -Q git") != 0:
+    if not "git" in packages_provided():
         os.system("pacman --noconfirm -Sy git")
 
-    if os.system("paru --version") != 0:
+    packages_invalidate()
+    if not "paru" in packages_provided():
         if os.path.isdir("/tmp/paru"):
             shutil.rmtree("/tmp/paru")
 
         os.system("git clone https://aur.archlinux.org/paru.git /tmp/paru && chown -R mam:mam /tmp/paru")
         os.system("mkdir -p /tmp/mam && chown mam:mam /tmp/mam")
         os.system("cd /tmp/paru && sudo -u mam HOME=/tmp/mam makepkg --noconfirm -sir")
+        packages_invalidate()
 
     print("Creating directories...")
-    for type in ["files", "directories", "packages", "partials", "additionals"]:
-        os.makedirs(f"{DIR}/objects/{type}", exist_ok=True)
-        os.makedirs(f"{DIR}/backups/{type}", exist_ok=True)
+    os.makedirs(f"{DIR}/backups/blobs", 0o700, exist_ok=True)
+    os.chmod(f"{DIR}/backups", 0o700)
 
     print("Installing mam...")
     shutil.copy(__file__, "/usr/local/bin/mam")
@@ -556,9 +1909,9 @@ def action_install():
         f.write("\n")
         f.write("[Service]\n")
         f.write("Type=simple\n")
-        f.write("ExecStart=/usr/local/bin/mam sync\n")
+        f.write("ExecStart=/usr/local/bin/mam watch\n")
         f.write("Restart=always\n")
-        f.write("RestartSec=600\n")
+        f.write("RestartSec=60\n")
         f.write("\n")
         f.write("[Install]\n")
         f.write("WantedBy=default.target\n")
@@ -594,27 +1947,27 @@ def action_uninstall():
     os.remove("/etc/systemd/system/mam.service")
 
     print("Restoring local files...")
-    for obj in os.listdir(f"{DIR}/objects/files"):
+    for obj in state_list("files"):
         file_restore(obj)
 
     print("Restoring local directories...")
-    for obj in os.listdir(f"{DIR}/objects/directories"):
+    for obj in state_list("directories"):
         directory_restore(obj)
 
     print("Restoring local packages...")
-    for obj in os.listdir(f"{DIR}/objects/packages"):
+    for obj in state_list("packages"):
         package_restore(obj)
 
     print("Restoring local partials...")
-    for obj in os.listdir(f"{DIR}/objects/partials"):
+    for obj in state_list("partials"):
         partial_restore(obj)
 
     print("Restoring local additionals...")
-    for obj in os.listdir(f"{DIR}/objects/additionals"):
+    for obj in state_list("additionals"):
         additional_restore(obj)
 
     print("Removing created directories...")
-    dirs = json_read(f"{DIR}/objects/created_dirs", [])
+    dirs = [row[0] for row in query("SELECT path FROM created_dirs")]
     dirs = sorted(dirs, key=lambda dir: dir.count("/"), reverse=True)
     for dir in dirs:
         try:
@@ -652,20 +2005,27 @@ def action_update():
 def action_status():
     requireAuth()
 
-    if not os.path.isfile(f"{DIR}/state"):
+    rows = query("SELECT start, end, requests, connections, bytes, wire FROM syncs ORDER BY start DESC LIMIT 1")
+    if len(rows) == 0:
         print("Not synced.")
         return
 
-    with open(f"{DIR}/state", "r") as f:
-        print(f.read())
+    start, end, requests, connections, bytes, wire = rows[0]
+    if end == None:
+        print(f"Syncing... (started {date(start)})")
+        return
+
+    print(f"Last sync: {date(end)}")
+    print(f"Requests: {requests} over {connections} connection(s)")
+    print(f"Transferred: {wire >> 10} KiB ({bytes / wire if wire > 0 else 1:.1f}x compression)")
 
 
 def action_list():
-    requireAuth()
+    manifest = requireAuth("sync-manifest")
 
     print("Synchronized files:")
-    local_objects = sorted(os.listdir(f"{DIR}/objects/files"), key=lambda obj: b32d(obj))
-    remote_objects = api("file-list")
+    local_objects = sorted(state_list("files"), key=lambda obj: b32d(obj))
+    remote_objects = manifest["files"]
 
     for obj in local_objects:
         if not obj in remote_objects:
@@ -673,7 +2033,7 @@ def action_list():
 
         file = b32d(obj)
         local_version = file_version(obj)
-        remote_version = remote_objects[obj]
+        remote_version = remote_objects[obj]["version"]
         local_sync_version, remote_sync_version = file_syncVersion(obj)
 
         if remote_version > remote_sync_version:
@@ -687,15 +2047,15 @@ def action_list():
 
     for obj in remote_objects:
         if not obj in local_objects:
-            print(f"  {b32d(obj)} ({date(remote_objects[obj])}, remote only)")
+            print(f"  {b32d(obj)} ({date(remote_objects[obj]['version'])}, remote only)")
 
     for obj in local_objects:
         if not obj in remote_objects:
             print(f"  {b32d(obj)} ({date(file_version(obj))}, local only)")
 
     print("\nSynchronized directories:")
-    local_objects = sorted(os.listdir(f"{DIR}/objects/directories"), key=lambda obj: b32d(obj))
-    remote_objects = api("directory-list")
+    local_objects = sorted(state_list("directories"), key=lambda obj: b32d(obj))
+    remote_objects = manifest["directories"]
 
     for obj in local_objects:
         if not obj in remote_objects:
@@ -703,7 +2063,7 @@ def action_list():
 
         directory = b32d(obj)
         local_version = directory_version(obj)
-        remote_version = remote_objects[obj]
+        remote_version = remote_objects[obj]["version"]
         local_sync_version, remote_sync_version = directory_syncVersion(obj)
 
         if remote_version > remote_sync_version:
@@ -717,15 +2077,15 @@ def action_list():
 
     for obj in remote_objects:
         if not obj in local_objects:
-            print(f"  {b32d(obj)} ({date(remote_objects[obj])}, remote only)")
+            print(f"  {b32d(obj)} ({date(remote_objects[obj]['version'])}, remote only)")
 
     for obj in local_objects:
         if not obj in remote_objects:
             print(f"  {b32d(obj)} ({date(directory_version(obj))}, local only)")
 
     print("\nSynchronized packages:")
-    local_objects = sorted(os.listdir(f"{DIR}/objects/packages"), key=lambda obj: b32d(obj))
-    remote_objects = api("package-list")
+    local_objects = sorted(state_list("packages"), key=lambda obj: b32d(obj))
+    remote_objects = manifest["packages"]
 
     for obj in local_objects:
         if obj in remote_objects:
@@ -740,8 +2100,8 @@ def action_list():
             print(f"  {b32d(obj)} (local only)")
 
     print("\nSynchronized partials:")
-    local_objects = sorted(os.listdir(f"{DIR}/objects/partials"), key=lambda obj: b32d(obj))
-    remote_objects = api("partial-list")
+    local_objects = sorted(state_list("partials"), key=lambda obj: b32d(obj))
+    remote_objects = manifest["partials"]
 
     for obj in local_objects:
         if not obj in remote_objects:
@@ -749,7 +2109,7 @@ def action_list():
 
         partial = b32d(obj)
         local_version = partial_version(obj)
-        remote_version = remote_objects[obj]
+        remote_version = remote_objects[obj]["version"]
         local_sync_version, remote_sync_version = partial_syncVersion(obj)
 
         if remote_version > remote_sync_version:
@@ -761,21 +2121,20 @@ def action_list():
         else:
             print(f"  {partial} ({date(remote_version)})")
 
-        partial_printDetails(obj)
+        partial_printDetails(remote_objects[obj]["content"])
 
     for obj in remote_objects:
         if not obj in local_objects:
-            print(f"  {b32d(obj)} ({date(remote_objects[obj])}, remote only)")
-            partial_printDetails(obj)
+            print(f"  {b32d(obj)} ({date(remote_objects[obj]['version'])}, remote only)")
+            partial_printDetails(remote_objects[obj]["content"])
 
     for obj in local_objects:
         if not obj in remote_objects:
             print(f"  {b32d(obj)} ({date(partial_version(obj))}, local only)")
-            partial_printDetails(obj)
 
     print("\nSynchronized additionals:")
-    local_objects = sorted(os.listdir(f"{DIR}/objects/additionals"), key=lambda obj: b32d(obj))
-    remote_objects = api("additional-list")
+    local_objects = sorted(state_list("additionals"), key=lambda obj: b32d(obj))
+    remote_objects = manifest["additionals"]
 
     for obj in local_objects:
         if not obj in remote_objects:
@@ -783,7 +2142,7 @@ def action_list():
 
         additional = b32d(obj)
         local_version = additional_version(obj)
-        remote_version = remote_objects[obj]
+        remote_version = remote_objects[obj]["version"]
         local_sync_version, remote_sync_version = additional_syncVersion(obj)
 
         if remote_version > remote_sync_version:
@@ -797,113 +2156,136 @@ def action_list():
 
     for obj in remote_objects:
         if not obj in local_objects:
-            print(f"  {b32d(obj)} ({date(remote_objects[obj])}, remote only)")
+            print(f"  {b32d(obj)} ({date(remote_objects[obj]['version'])}, remote only)")
 
     for obj in local_objects:
         if not obj in remote_objects:
             print(f"  {b32d(obj)} ({date(additional_version(obj))}, local only)")
 
 
-def action_sync():
-    requireAuth()
+def action_sync(refresh: bool = False) -> int:
+    manifest = requireAuth("sync-manifest")
+    SCANS.clear()
 
-    with open(f"{DIR}/state", "w") as f:
-        f.write("Syncing...")
+    start = int(datetime.now().timestamp())
+    query("INSERT OR REPLACE INTO syncs (start) VALUES (?)", (start,))
+    DB.commit()
+    transfers_prune()
 
-    local_files = os.listdir(f"{DIR}/objects/files")
-    remote_files = api("file-list")
+    local_files = state_list("files")
+    remote_files = manifest["files"]
     for file in local_files:
         if not file in remote_files:
             file_restore(file)
 
-    local_directories = os.listdir(f"{DIR}/objects/directories")
-    remote_directories = api("directory-list")
+    local_directories = state_list("directories")
+    remote_directories = manifest["directories"]
     for directory in local_directories:
         if not directory in remote_directories:
             directory_restore(directory)
 
-    local_packages = os.listdir(f"{DIR}/objects/packages")
-    remote_packages = api("package-list")
+    local_packages = state_list("packages")
+    remote_packages = manifest["packages"]
     for package in local_packages:
         if not package in remote_packages:
             package_restore(package)
 
-    local_partials = os.listdir(f"{DIR}/objects/partials")
-    remote_partials = api("partial-list")
+    local_partials = state_list("partials")
+    remote_partials = manifest["partials"]
     for partial in local_partials:
         if not partial in remote_partials:
             partial_restore(partial)
 
-    local_additionals = os.listdir(f"{DIR}/objects/additionals")
-    remote_additionals = api("additional-list")
+    local_additionals = state_list("additionals")
+    remote_additionals = manifest["additionals"]
     for additional in local_additionals:
         if not additional in remote_additionals:
             additional_restore(additional)
 
-    for file in remote_files:
-        if not file in local_files:
-            file_backup(file)
-            file_download(file, remote_files[file])
-        else:
-            local_version = file_version(file)
-            remote_version = remote_files[file]
-            local_sync_version, remote_sync_version = file_syncVersion(file)
-
-            if remote_version > remote_sync_version or local_version == 0:
-                file_download(file, remote_version)
-            elif local_version > local_sync_version:
-                file_upload(file)
-
-    for directory in remote_directories:
-        if not directory in local_directories:
-            directory_backup(directory)
-            directory_download(directory, remote_directories[directory])
-        else:
-            local_version = directory_version(directory)
-            remote_version = remote_directories[directory]
-            local_sync_version, remote_sync_version = directory_syncVersion(directory)
-
-            if remote_version > remote_sync_version or local_version == 0:
-                directory_download(directory, remote_version)
-            elif local_version > local_sync_version:
-                directory_upload(directory)
-
+    backups_prune()
+    parallel(
+        [(object_sync, "files", file, remote_files[file], not file in local_files) for file in remote_files]
+        + [
+            (object_sync, "directories", directory, remote_directories[directory], not directory in local_directories)
+            for directory in remote_directories
+        ]
+    )
+    api_flush()
+
+    installed = packages_installed()
     for package in remote_packages:
         if not package in local_packages:
-            package_backup(package)
-
-        package_install(package)
-
-    for partial in remote_partials:
-        if not partial in local_partials:
-            partial_backup(partial)
-            partial_download(partial, remote_partials[partial])
-        else:
-            local_version = partial_version(partial)
-            remote_version = remote_partials[partial]
-            local_sync_version, remote_sync_version = partial_syncVersion(partial)
-
-            if remote_version > remote_sync_version or local_version == 0:
-                partial_download(partial, remote_version)
-            elif local_version > local_sync_version:
-                partial_upload(partial)
-
-    for additional in remote_additionals:
-        if not additional in local_additionals:
-            additional_backup(additional)
-            additional_download(additional, remote_additionals[additional])
-        else:
-            local_version = additional_version(additional)
-            remote_version = remote_additionals[additional]
-            local_sync_version, remote_sync_version = additional_syncVersion(additional)
-
-            if remote_version > remote_sync_version or local_version == 0:
-                additional_download(additional, remote_version)
-            elif local_version > local_sync_version:
-                additional_upload(additional)
+            package_backup(package, installed)
+
+    packages_install(remote_packages, installed, refresh)
+
+    parallel(
+        [(object_sync, "partials", partial, remote_partials[partial], not partial in local_partials) for partial in remote_partials]
+        + [
+            (object_sync, "additionals", additional, remote_additionals[additional], not additional in local_additionals)
+            for additional in remote_additionals
+        ]
+    )
+    api_flush()
+    query(
+        "UPDATE syncs SET end = ?, requests = ?, connections = ?, bytes = ?, wire = ? WHERE start = ?",
+        (int(datetime.now().timestamp()), STATS["requests"], STATS["connections"], STATS["bytes"], STATS["wire"], start),
+    )
+    DB.commit()
+
+    print(f"Synced with {STATS['requests']} requests over {STATS['connections']} connection(s).")
+    print(f"Transferred {STATS['wire'] >> 10} KiB ({compressionRatio():.1f}x compression).")
+    if STATS["failed"] > 0:
+        print(f"{STATS['failed']} request(s) failed, affected objects will be retried on the next sync.")
+    return manifest["revision"]
+
+
+def action_watch():
+    changes = queue.SimpleQueue()
+    notify, wake = os.pipe()
+    remote = None
 
-    with open(f"{DIR}/state", "w") as f:
-        f.write(f"Last sync: {date()}")
+    while True:
+        count_reset()
+        revision = action_sync()
+        if remote == None:
+            remote = threading.Thread(target=watch_remote, args=(revision, changes, wake), daemon=True)
+            remote.start()
+
+        fd = inotify_init()
+        watches = watch_objects(fd)
+        deadline = time.monotonic() + WATCH_RECONCILE
+        while time.monotonic() < deadline:
+            changed = set()
+            ready = select.select([fd, notify], [], [], max(deadline - time.monotonic(), 0))[0]
+            if notify in ready:
+                os.read(notify, 1 << 10)
+                while not changes.empty():
+                    changed.update(changes.get())
+
+            events = inotify_read(fd) if fd in ready else []
+            settle = min(deadline, time.monotonic() + WATCH_SETTLE)
+            while len(events) > 0:
+                for wd, mask, name in events:
+                    if mask & IN_Q_OVERFLOW:
+                        deadline = 0
+
+                    for type, obj, target, path in list(watches.get(wd, [])):
+                        if target == None or target == name:
+                            changed.add((type, obj))
+                            if type == "directories" and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                                for root, _, _ in os.walk(os.path.join(path, name)):
+                                    watch_add(fd, watches, root, (type, obj, None))
+
+                wait = min(WATCH_DEBOUNCE, settle - time.monotonic(), deadline - time.monotonic())
+                events = inotify_read(fd) if wait > 0 and select.select([fd], [], [], wait)[0] else []
+
+            if len(changed) > 0 and deadline > 0:
+                count_reset()
+                if not watch_sync(changed):
+                    deadline = 0
+
+        os.close(fd)
 
 
 def action_addFile(path: str):
@@ -934,6 +2316,7 @@ def action_addFile(path: str):
     file_backup(obj)
     api("file-create", {"id": obj})
     file_upload(obj)
+    api_flush()
     print("File added!")
 
 
@@ -993,6 +2376,7 @@ def action_addDirectory(path: str):
     directory_backup(obj)
     api("directory-create", {"id": obj})
     directory_upload(obj)
+    api_flush()
     print("Directory added!")
 
 
@@ -1018,9 +2402,10 @@ def action_addPackage(name: str):
         print("Package is already synced.")
         sys.exit(1)
 
-    package_backup(obj)
+    installed = packages_installed()
+    package_backup(obj, installed)
     api("package-add", {"id": obj})
-    package_install(obj)
+    packages_install({obj: {"id": obj, "source": None}}, installed)
     print("Package added!")
 
 
@@ -1063,7 +2448,8 @@ def action_addPartial(path: str, pattern: str, section: str | None):
     content = api("partial-get-content", {"id": obj})
     content.append({"pattern": pattern, "value": "", "section": section})
     api("partial-set-content", {"id": obj, "content": content, "version": int(datetime.now().timestamp())})
-    partial_upload(obj)
+    partial_upload(obj, True)
+    api_flush()
     print("Partial added!")
 
 
@@ -1078,7 +2464,7 @@ def action_removePartial(path: str, pattern: str, section: str | None):
     content = [cnt for cnt in content if cnt["pattern"] != pattern or cnt["section"] != section]
     version = int(datetime.now().timestamp())
     api("partial-set-content", {"id": obj, "content": content, "version": version})
-    partial_download(obj, version)
+    partial_download(obj, {**api("partial-get-meta", {"id": obj}), "content": content})
     print("Partial removed!")
 
 
@@ -1121,14 +2507,13 @@ def action_addAdditional(path: str, prefix: str):
 
     additional_backup(obj)
 
-    lines = lines_read(additional)
-    if not f"{prefix} BEGIN MAM ADDITIONAL" in lines:
-        lines.append(f"{prefix} BEGIN MAM ADDITIONAL")
-        lines.append(f"{prefix} END MAM ADDITIONAL")
-        lines_write(additional, lines)
+    data = file_read(additional)
+    if additional_block(data, prefix) == None:
+        file_splice(additional, data, [additional_edit(data, prefix, [])])
 
     api("additional-create", {"id": obj, "prefix": prefix})
-    additional_upload(obj)
+    additional_upload(obj, True)
+    api_flush()
     print("Additional added!")
 
 
@@ -1151,6 +2536,12 @@ if __name__ == "__main__":
 
     os.makedirs(DIR, exist_ok=True)
     CONFIG = json_read(f"{DIR}/config", CONFIG)
+    try:
+        JOBS = max(1, int(CONFIG.get("jobs", JOBS)))
+    except (TypeError, ValueError):
+        pass
+
+    DB = database()
 
     match arg(1):
         case "install":
@@ -1178,8 +2569,12 @@ if __name__ == "__main__":
             action_list()
 
         case "sync":
-            requireArgs(2, "Usage: mam sync")
-            action_sync()
+            requireArgs([2, 3], "Usage: mam sync [--refresh]")
+            action_sync(arg(2) == "--refresh")
+
+        case "watch":
+            requireArgs(2, "Usage: mam watch")
+            action_watch()
 
         case "add":
             match arg(2):
@@ -1260,7 +2655,10 @@ if __name__ == "__main__":
             print("mam update     Update mam binary to latest version")
             print("mam status     Show last sync status")
             print("mam list       List all synced objects")
-            print("mam sync       Sync all objects")
+            print("mam sync       Sync all objects (--refresh to re-detect whether packages come from a repository or the AUR)")
+            print("mam watch      Sync all objects and push local changes as they happen")
             print("mam add        Add an object to sync")
             print("mam remove     Remove an object from sync")
             sys.exit(1)
+
+    DB.commit()